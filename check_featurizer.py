@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+
+import datasets
+import models
+import utils
+
+
+# max absolute difference allowed for melspec (dB), pcen and clean_mel (dB)
+TOLERANCES = [1e-3, 1e-3, 1e-3]
+N_SAMPLES = 16
+
+
+if __name__ == "__main__":
+    # compare models.featurizer.SpectrogramFeaturizer against the CPU features of
+    # AdditionalLabelDataset on the same clips before using it for training
+    args = utils.get_parser().parse_args()
+    config = utils.load_config(args.config)
+
+    dataset_config = config["dataset"]["train"]
+    if dataset_config["name"] != "AdditionalLabelDataset":
+        raise ValueError("the featurizer is only checked against AdditionalLabelDataset")
+    params = dict(dataset_config["params"])
+    params.pop("precomputed_dir", None)
+    featurizer_params = config["model"].get("featurizer")
+    if featurizer_params is None:
+        raise ValueError("model.featurizer is not set")
+
+    tp, fp, train_all, _, train_audio, _ = datasets.get_metadata(config)
+    dataset = datasets.AdditionalLabellDataset(train_all, tp, fp, train_audio, **params)
+    featurizer = models.SpectrogramFeaturizer(**featurizer_params)
+    featurizer.eval()
+
+    errors = np.zeros(3)
+    for idx in range(min(N_SAMPLES, len(dataset.tp))):
+        sample = dataset.tp.loc[idx]
+        offset = dataset.get_offset(sample["t_min"], sample["t_max"])
+        y = dataset.get_waveform(sample["recording_id"], offset)
+        expected = dataset.compute_features(y)
+        with torch.no_grad():
+            actual = featurizer.compute_features(torch.from_numpy(y)[None])
+        for i in range(3):
+            errors[i] = max(errors[i], float(np.abs(actual[i][0].numpy() - expected[i]).max()))
+
+    for name, error, tolerance in zip(["melspec", "pcen", "clean_mel"], errors, TOLERANCES):
+        print(f"{name}: max abs error {error:.6f} (tolerance {tolerance})")
+    if np.any(errors > np.array(TOLERANCES)):
+        raise ValueError("SpectrogramFeaturizer does not match AdditionalLabelDataset features")
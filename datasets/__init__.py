@@ -1,11 +1,16 @@
+import os
+
+import numpy as np
 import pandas as pd
+import torch
 import torch.utils.data as torchdata
 
 import transforms
 
 from pathlib import Path
 
-from .additional_label import AdditionalLabellDataset
+from .additional_label import AdditionalLabellDataset, WaveformOnlyDataset, precompute_features
+from .cache import CachedSequentialDataset
 from .cpmp import RandomSamplingRateAndDurationSpectrogramDataset
 from .fp_sample import SampleFPSpectrogramDataset
 from .freq_limit_input import (LimitedFrequencySpectrogramDataset, LimitedFrequencySequentialValidationDataset,
@@ -52,6 +57,8 @@ __DATASETS__ = {
     "SpectrogramTTADataset": SpectrogramTTADataset,
     "WaveformMixupDataset": WaveformMixupDataset,
     "CropChangedFasterMLSpectrogramDataset": CropChangedFasterMLSpectrogramDataset,
+    "WaveformOnlyDataset": WaveformOnlyDataset,
+    "CachedSequentialDataset": CachedSequentialDataset,
 }
 
 
@@ -74,6 +81,10 @@ def get_metadata(config: dict):
 
         tp = pd.concat([tp, tp_additional_labels], axis=0).reset_index(drop=True)
 
+    # ids fit in int16, which makes groupby / unique below cheaper
+    tp = tp.astype({"species_id": "int16", "songtype_id": "int16"})
+    fp = fp.astype({"species_id": "int16", "songtype_id": "int16"})
+
     train_audios = list(train_audio.glob("*.flac"))
     if len(train_audios) == 0:
         train_audios = list(train_audio.glob("*.wav"))
@@ -82,89 +93,144 @@ def get_metadata(config: dict):
     if len(test_audios) == 0:
         test_audios = list(test_audio.glob("*.wav"))
 
-    train_audio_lists = [audio.name.replace(".flac", "").replace(".wav", "") for audio in train_audios]
-    test_audio_lists = [audio.name.replace(".flac", "").replace(".wav", "") for audio in test_audios]
+    train_audio_lists = [audio.stem for audio in train_audios]
+    test_audio_lists = [audio.stem for audio in test_audios]
     train_all = pd.DataFrame({
         "recording_id": train_audio_lists
     })
     test_all = pd.DataFrame({
         "recording_id": test_audio_lists
     })
-    clip_level_tp = tp.groupby("recording_id")["species_id"].apply(list)
-    clip_level_fp = fp.groupby("recording_id")["species_id"].apply(list)
-
-    tp["species_id_song_id"] = tp["species_id"].map(str) + "_" + tp["songtype_id"].map(str)
-    fp["species_id_song_id"] = fp["species_id"].map(str) + "_" + fp["songtype_id"].map(str)
+    tp["species_id_song_id"] = tp["species_id"].astype(str).str.cat(tp["songtype_id"].astype(str), sep="_")
+    fp["species_id_song_id"] = fp["species_id"].astype(str).str.cat(fp["songtype_id"].astype(str), sep="_")
 
     tp = tp.reset_index(drop=False)
     fp = fp.reset_index(drop=False)
 
-    clip_level_tp_joint = tp.groupby("recording_id")["species_id_song_id"].apply(list)
-    clip_level_fp_joint = fp.groupby("recording_id")["species_id_song_id"].apply(list)
+    clip_level = {
+        "tp": tp.groupby("recording_id")["species_id"].apply(list)
+    }
+    # fp side and joint columns are not used by the datasets, only build them on demand
+    need_fp_clip_level = data_config.get("need_fp_clip_level", False)
+    if need_fp_clip_level:
+        clip_level["fp"] = fp.groupby("recording_id")["species_id"].apply(list)
+        clip_level["tp_species_id_song_id"] = tp.groupby("recording_id")["species_id_song_id"].apply(list)
+        clip_level["fp_species_id_song_id"] = fp.groupby("recording_id")["species_id_song_id"].apply(list)
 
-    train_all = train_all.merge(clip_level_tp, on="recording_id", how="left").rename(
-        columns={"species_id": "tp"})
-    train_all = train_all.merge(clip_level_fp, on="recording_id", how="left").rename(
-        columns={"species_id": "fp"})
-    train_all = train_all.merge(clip_level_tp_joint, on="recording_id", how="left").rename(
-        columns={"species_id_song_id": "tp_species_id_song_id"})
-    train_all = train_all.merge(clip_level_fp_joint, on="recording_id", how="left").rename(
-        columns={"species_id_song_id": "fp_species_id_song_id"})
+    clip_level = pd.DataFrame(clip_level).rename_axis("recording_id").reset_index()
+    train_all = train_all.merge(clip_level, on="recording_id", how="left")
 
     train_all["n_tp"] = train_all.tp.map(lambda x: len(x) if isinstance(x, list) else 0)
-    train_all["n_fp"] = train_all.fp.map(lambda x: len(x) if isinstance(x, list) else 0)
-    train_all["n_tp_fp"] = train_all["n_tp"] + train_all["n_fp"]
+    if need_fp_clip_level:
+        train_all["n_fp"] = train_all.fp.map(lambda x: len(x) if isinstance(x, list) else 0)
+        train_all["n_tp_fp"] = train_all["n_tp"] + train_all["n_fp"]
 
     return tp, fp, train_all, test_all, train_audio, test_audio
 
 
+def worker_init_fn(worker_id: int):
+    # numpy state is copied from the parent process, so without this
+    # every worker draws the same random crops / augmentations
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+def set_worker_defaults(loader_config: dict, persistent: bool):
+    # more workers than cpus only adds context switches, and prefetching more than
+    # a few batches per worker holds memory without making loading faster
+    # loaders without num_workers in the config keep loading in the main process
+    num_workers = min(loader_config.get("num_workers", 0), os.cpu_count() or 1)
+    loader_config["num_workers"] = num_workers
+    if num_workers > 0:
+        loader_config.setdefault("prefetch_factor", 4)
+        if persistent:
+            loader_config.setdefault("persistent_workers", True)
+    return loader_config
+
+
+WAVEFORM_DATASETS = ["WaveformDataset", "WaveformValidDataset", "MultiLabelWaveformDataset"]
+SPECTROGRAM_DATASETS = ["SpectrogramDataset", "MultiLabelSpectrogramDataset",
+                        "SampleFPSpectrogramDataset", "TorchAudioMLDataset",
+                        "FasterMLSpectrogramDataset", "LogmelMixupDataset",
+                        "SampleWiseSpectrogramDataset", "LogmelMixupWithFPDataset",
+                        "SequentialValidationDataset", "CachedSequentialDataset",
+                        "LimitedFrequencySpectrogramDataset",
+                        "LimitedFrequencySequentialValidationDataset",
+                        "RandomFasterMLSpectrogramDataset",
+                        "RandomCropMixupDataset",
+                        "AdditionalLabelDataset",
+                        "WaveformOnlyDataset",
+                        "WaveformMixupDataset",
+                        "CropChangedFasterMLSpectrogramDataset",
+                        "RandomSamplingRateAndDurationSpectrogramDataset"]
+
+
+def get_train_loader_factory(tp: pd.DataFrame,
+                             fp: pd.DataFrame,
+                             datadir: Path,
+                             config: dict):
+    # transforms only depend on config and phase, so they are built once and
+    # shared by the loaders of every fold / frequency range
+    dataset_config = config["dataset"]
+    transforms_cache = {}
+
+    def get_transforms(phase: str):
+        if phase not in transforms_cache:
+            transforms_cache[phase] = (transforms.get_waveform_transforms(config, phase),
+                                       transforms.get_spectrogram_transforms(config, phase))
+        return transforms_cache[phase]
+
+    def make_loader(df: pd.DataFrame, phase: str, frequency_range=None):
+        loader_config = dict(config["loader"][phase])
+        # pin_memory pairs with .to(device, non_blocking=True) in the training loop,
+        # persistent_workers keeps workers (and what they cached) alive across epochs.
+        # both can be turned off in the loader config
+        loader_config.setdefault("pin_memory", True)
+        loader_config.setdefault("worker_init_fn", worker_init_fn)
+        set_worker_defaults(loader_config, persistent=True)
+
+        name = dataset_config[phase]["name"]
+        params = dataset_config[phase]["params"]
+        if frequency_range is not None:
+            params = dict(params, frequency_range=frequency_range)
+        waveform_transforms, spectrogram_transforms = get_transforms(phase)
+        if name in WAVEFORM_DATASETS:
+            dataset = __DATASETS__[name](
+                df, tp, fp, datadir, waveform_transforms, **params)
+        elif name in SPECTROGRAM_DATASETS:
+            dataset = __DATASETS__[name](
+                df, tp, fp, datadir,
+                waveform_transforms,
+                spectrogram_transforms,
+                **params)
+        else:
+            raise NotImplementedError
+        loader = torchdata.DataLoader(dataset, **loader_config)
+        return loader
+
+    return make_loader
+
+
 def get_train_loader(df: pd.DataFrame,
                      tp: pd.DataFrame,
                      fp: pd.DataFrame,
                      datadir: Path,
                      config: dict,
                      phase: str):
-    dataset_config = config["dataset"]
-    loader_config = config["loader"][phase]
-    if dataset_config[phase]["name"] in ["WaveformDataset", "WaveformValidDataset",
-                                         "MultiLabelWaveformDataset"]:
-        transform = transforms.get_waveform_transforms(config, phase)
-        params = dataset_config[phase]["params"]
-
-        dataset = __DATASETS__[dataset_config[phase]["name"]](
-            df, tp, fp, datadir, transform, **params)
-    elif dataset_config[phase]["name"] in ["SpectrogramDataset", "MultiLabelSpectrogramDataset",
-                                           "SampleFPSpectrogramDataset", "TorchAudioMLDataset",
-                                           "FasterMLSpectrogramDataset", "LogmelMixupDataset",
-                                           "SampleWiseSpectrogramDataset", "LogmelMixupWithFPDataset",
-                                           "SequentialValidationDataset", "LimitedFrequencySpectrogramDataset",
-                                           "LimitedFrequencySequentialValidationDataset",
-                                           "RandomFasterMLSpectrogramDataset",
-                                           "RandomCropMixupDataset",
-                                           "AdditionalLabelDataset",
-                                           "WaveformMixupDataset",
-                                           "CropChangedFasterMLSpectrogramDataset",
-                                           "RandomSamplingRateAndDurationSpectrogramDataset"]:
-        waveform_transforms = transforms.get_waveform_transforms(config, phase)
-        spectrogram_transforms = transforms.get_spectrogram_transforms(config, phase)
-        params = dataset_config[phase]["params"]
-
-        dataset = __DATASETS__[dataset_config[phase]["name"]](
-            df, tp, fp, datadir,
-            waveform_transforms,
-            spectrogram_transforms,
-            **params)
-    else:
-        raise NotImplementedError
-    loader = torchdata.DataLoader(dataset, **loader_config)
-    return loader
+    return get_train_loader_factory(tp, fp, datadir, config)(df, phase)
 
 
 def get_test_loader(df: pd.DataFrame,
                     datadir: Path,
                     config: dict):
     dataset_config = config["dataset"]
-    loader_config = config["loader"]["test"]
+    loader_config = dict(config["loader"]["test"])
+    loader_config.setdefault("pin_memory", True)
+    # test loaders are iterated once, keeping their workers alive would only hold memory
+    set_worker_defaults(loader_config, persistent=False)
+    # there is no backward pass at inference, so it can use larger batches than training
+    inference_batch_size = loader_config.pop("inference_batch_size", None)
+    if inference_batch_size is not None:
+        loader_config["batch_size"] = inference_batch_size
     if dataset_config["test"]["name"] in ["WaveformTestDataset"]:
         transform = transforms.get_waveform_transforms(config, "test")
         params = dataset_config["test"]["params"]
@@ -1,31 +1,19 @@
+import os
+
 import cv2
 import librosa
 import numpy as np
 import pandas as pd
+import soundfile as sf
+import soxr
+import torch
 import torch.utils.data as torchdata
 
 from pathlib import Path
 
+from .common import get_params_digest, get_scratch, normalize_melspec, split_melspectrogram_parameters, to_chw_float
 from .constants import N_CLASSES, CLIP_DURATION, CLASS_MAP
-
-
-def normalize_melspec(X: np.ndarray):
-    eps = 1e-6
-    mean = X.mean()
-    X = X - mean
-    std = X.std()
-    Xstd = X / (std + eps)
-    norm_min, norm_max = Xstd.min(), Xstd.max()
-    if (norm_max - norm_min) > eps:
-        V = Xstd
-        V[V < norm_min] = norm_min
-        V[V > norm_max] = norm_max
-        V = 255 * (V - norm_min) / (norm_max - norm_min)
-        V = V.astype(np.uint8)
-    else:
-        # Just zero
-        V = np.zeros_like(Xstd, dtype=np.uint8)
-    return V
+from .pcen import get_smoothing_coefficient
 
 
 class AdditionalLabellDataset(torchdata.Dataset):
@@ -38,7 +26,9 @@ class AdditionalLabellDataset(torchdata.Dataset):
                  duration=10,
                  centering=False,
                  additional_label_path=None,
-                 additional_label_value=0.8):
+                 additional_label_value=0.8,
+                 preload=False,
+                 precomputed_dir=None):
         unique_recording_id = df.recording_id.unique().tolist()
         unique_tp_recordin_id = tp.recording_id.unique().tolist()
         intersection = set(unique_recording_id).intersection(unique_tp_recordin_id)
@@ -54,45 +44,202 @@ class AdditionalLabellDataset(torchdata.Dataset):
         self.img_size = img_size
         self.duration = duration
         self.centering = centering
-        if self.melspectrogram_parameters.get("hop_length") is not None:
-            self.hop_length = self.melspectrogram_parameters["hop_length"]
+        self.stft_parameters, self.mel_basis, self.power = split_melspectrogram_parameters(
+            melspectrogram_parameters, sampling_rate)
+        self.hop_length = self.stft_parameters["hop_length"]
+
+        # shape of the spectrogram and of the resized image are fixed by the parameters
+        self.n_samples = int(self.sampling_rate * self.duration)
+        if self.stft_parameters.get("center", True):
+            n_stft_frames = 1 + self.n_samples // self.hop_length
         else:
-            self.hop_length = 512
+            n_stft_frames = 1 + (self.n_samples - self.stft_parameters["n_fft"]) // self.hop_length
+        self.melspec_shape = (self.mel_basis.shape[0], n_stft_frames)
+        self.dsize = (int(n_stft_frames * self.img_size / self.mel_basis.shape[0]), self.img_size)
+
+        # smoothing coefficient of pcen only depends on parameters
+        self.pcen_parameters = dict(pcen_parameters)
+        if self.pcen_parameters.get("b") is None:
+            self.pcen_parameters["b"] = get_smoothing_coefficient(
+                sampling_rate, self.pcen_parameters.get("hop_length", 512), self.pcen_parameters.get("time_constant", 0.4))
+
+        self.paths = {
+            recording_id: str(datadir / f"{recording_id}.flac")
+            for recording_id in self.tp.recording_id.unique()
+        }
+
+        # per recording event arrays so that __getitem__ doesn't need to scan the whole table
+        self.tp_by_recording = {}
+        for recording_id, group in self.tp.groupby("recording_id"):
+            self.tp_by_recording[recording_id] = (
+                group["t_min"].to_numpy(np.float64),
+                group["t_max"].to_numpy(np.float64),
+                group["species_id"].to_numpy(np.int64),
+                group["species_id_song_id"].map(CLASS_MAP).to_numpy(np.int64))
+
+        self.additional_labels = None
+        self.additional_labels_by_recording = {}
         if additional_label_path is not None:
             self.additional_labels = pd.read_csv(additional_label_path)
+            self.additional_labels_by_recording = {
+                filename: group["species"].to_numpy(np.int64)
+                for filename, group in self.additional_labels.groupby("filename")
+            }
         self.additional_label_value = additional_label_value
 
+        # decode every recording once and keep it as int16 in shared memory,
+        # so that DataLoader workers can slice it without multiplying RAM
+        self.preload = preload
+        if self.preload:
+            self.recording_index = {}
+            n_samples = int(CLIP_DURATION * self.sampling_rate)
+            self.waveforms = torch.zeros((len(self.paths), n_samples), dtype=torch.int16).share_memory_()
+            self.waveform_lengths = np.zeros(len(self.paths), dtype=np.int64)
+            for i, recording_id in enumerate(self.paths):
+                y = self.load_audio(recording_id, 0, CLIP_DURATION)[:n_samples]
+                y = np.clip(y * 32768.0, -32768, 32767).astype(np.int16)
+                self.waveforms[i, :len(y)] = torch.from_numpy(y)
+                self.waveform_lengths[i] = len(y)
+                self.recording_index[recording_id] = i
+
+        # features are cached on disk per (recording_id, offset) when waveform
+        # augmentation is disabled, since they are deterministic then. the directory
+        # is keyed by the parameters the features depend on
+        self.precomputed_dir = None
+        if precomputed_dir is not None:
+            digest = get_params_digest({
+                "datadir": str(datadir),
+                "melspectrogram_parameters": melspectrogram_parameters,
+                "pcen_parameters": pcen_parameters,
+                "sampling_rate": sampling_rate,
+                "duration": duration,
+                "preload": preload
+            })
+            self.precomputed_dir = Path(precomputed_dir) / f"features_{digest}"
+        if self.precomputed_dir is not None:
+            self.precomputed_dir.mkdir(exist_ok=True, parents=True)
+
+        self.rng = None
+        self.rng_pid = None
+
     def __len__(self):
         return len(self.tp)
 
-    def __getitem__(self, idx: int):
-        sample = self.tp.loc[idx, :]
-        index = sample["index"]
-        flac_id = sample["recording_id"]
+    def get_rng(self):
+        # created lazily so that each DataLoader worker gets its own stream
+        # instead of a copy of the one in the parent process
+        if self.rng is None or self.rng_pid != os.getpid():
+            self.rng = np.random.default_rng(torch.initial_seed())
+            self.rng_pid = os.getpid()
+        return self.rng
 
-        t_min = sample["t_min"]
-        t_max = sample["t_max"]
+    def load_audio(self, flac_id: str, offset: float, duration: float):
+        # seek instead of decoding from the head of the file
+        with sf.SoundFile(self.paths[flac_id]) as f:
+            f.seek(int(offset * f.samplerate))
+            y = f.read(int(duration * f.samplerate), dtype="float32", always_2d=False)
+            orig_sr = f.samplerate
+        if y.ndim > 1:
+            y = y.mean(axis=1)
+        if orig_sr != self.sampling_rate:
+            y = soxr.resample(y, orig_sr, self.sampling_rate)
+        return y
+
+    def get_waveform(self, flac_id: str, offset: float):
+        if self.preload:
+            i = self.recording_index[flac_id]
+            start = int(offset * self.sampling_rate)
+            end = min(start + int(self.duration * self.sampling_rate), self.waveform_lengths[i])
+            return self.waveforms[i, start:end].numpy().astype(np.float32) / 32768.0
+        return self.load_audio(flac_id, offset, self.duration)
 
+    def compute_features(self, y: np.ndarray):
+        spec = np.abs(librosa.stft(y, **self.stft_parameters)) ** self.power
+        melspec = np.dot(self.mel_basis, spec)
+        pcen = librosa.pcen(melspec, sr=self.sampling_rate, **self.pcen_parameters)
+        clean_mel = librosa.power_to_db(melspec ** 1.5)
+        melspec = librosa.power_to_db(melspec)
+        return melspec, pcen, clean_mel
+
+    def load_features(self, flac_id: str, offset: float):
+        path = self.precomputed_dir / f"{flac_id}_{int(round(offset * 10))}.npy"
+        if path.exists():
+            features = np.load(path, mmap_mode="r")
+        else:
+            y = self.get_waveform(flac_id, offset)
+            features = np.stack(self.compute_features(y)).astype(np.float16)
+            # write to a temporary file first since other workers may read the same path
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, features)
+            os.replace(tmp_path, path)
+        return features[0].astype(np.float32), features[1].astype(np.float32), features[2].astype(np.float32)
+
+    def get_offset(self, t_min: float, t_max: float):
         if not self.centering:
-            offset = np.random.choice(np.arange(max(t_max - self.duration, 0), t_min, 0.1))
+            low = max(t_max - self.duration, 0.0)
+            high = max(t_min, low + 1e-6)
+            offset = np.round(self.get_rng().uniform(low, high) * 10) / 10
             offset = min(CLIP_DURATION - self.duration, offset)
         else:
             call_duration = t_max - t_min
             relative_offset = (self.duration - call_duration) / 2
             offset = min(max(0, t_min - relative_offset), CLIP_DURATION - self.duration)
-        y, sr = librosa.load(self.datadir / f"{flac_id}.flac",
-                             sr=self.sampling_rate,
-                             mono=True,
-                             offset=offset,
-                             duration=self.duration,
-                             res_type="kaiser_fast")
-        if self.waveform_transforms:
-            y = self.waveform_transforms(y).astype(np.float32)
+        return offset
 
-        melspec = librosa.feature.melspectrogram(y, sr=sr, **self.melspectrogram_parameters)
-        pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-        clean_mel = librosa.power_to_db(melspec ** 1.5)
-        melspec = librosa.power_to_db(melspec)
+    def get_targets(self, flac_id: str, offset: float, n_frames: int):
+        tail = offset + self.duration
+        t_mins, t_maxs, species_ids, songtype_ids = self.tp_by_recording[flac_id]
+        mask = (t_mins < tail) & (t_maxs > offset)
+        t_mins, t_maxs = t_mins[mask], t_maxs[mask]
+        species_ids, songtype_ids = species_ids[mask], songtype_ids[mask]
+
+        label = np.zeros(N_CLASSES, dtype=np.float32)
+        songtype_label = np.zeros(N_CLASSES + 2, dtype=np.float32)
+
+        frames_per_second = n_frames / self.duration
+        strong_label = np.zeros((n_frames, N_CLASSES), dtype=np.float32)
+        songtype_strong_label = np.zeros((n_frames, N_CLASSES + 2), dtype=np.float32)
+
+        # events straddling the clip boundary are clipped into [0, n_frames]
+        start_indices = np.clip(((t_mins - offset) * frames_per_second).astype(np.int32), 0, n_frames)
+        end_indices = np.clip(((t_maxs - offset) * frames_per_second).astype(np.int32), 0, n_frames)
+
+        label[species_ids] = 1.0
+
+        additional_species_ids = self.additional_labels_by_recording.get(flac_id)
+        if additional_species_ids is not None:
+            label[additional_species_ids] = self.additional_label_value
+
+        songtype_label[songtype_ids] = 1.0
+
+        for start_index, end_index, species_id, songtype_id in zip(
+                start_indices, end_indices, species_ids, songtype_ids):
+            strong_label[start_index:end_index, species_id] = 1.0
+            songtype_strong_label[start_index:end_index, songtype_id] = 1.0
+
+        return {
+            "weak": label,
+            "strong": strong_label,
+            "weak_songtype": songtype_label,
+            "strong_songtype": songtype_strong_label
+        }
+
+    def __getitem__(self, idx: int):
+        sample = self.tp.loc[idx, :]
+        index = sample["index"]
+        flac_id = sample["recording_id"]
+
+        offset = self.get_offset(sample["t_min"], sample["t_max"])
+        if self.precomputed_dir is not None and not self.waveform_transforms:
+            # snap to the grid precomputed features are stored on
+            offset = round(offset * 10) / 10
+            melspec, pcen, clean_mel = self.load_features(flac_id, offset)
+        else:
+            y = self.get_waveform(flac_id, offset)
+            if self.waveform_transforms:
+                y = self.waveform_transforms(y).astype(np.float32)
+            melspec, pcen, clean_mel = self.compute_features(y)
 
         if self.spectrogram_transforms:
             melspec = self.spectrogram_transforms(image=melspec)["image"]
@@ -101,60 +248,79 @@ class AdditionalLabellDataset(torchdata.Dataset):
         else:
             pass
 
-        norm_melspec = normalize_melspec(melspec)
-        norm_pcen = normalize_melspec(pcen)
-        norm_clean_mel = normalize_melspec(clean_mel)
-        image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
+        # each channel is normalized straight into the HWC uint8 image, then resized
+        image = get_scratch("spectrogram", melspec.shape + (3,), np.uint8)
+        normalize_melspec(melspec, image[..., 0])
+        normalize_melspec(pcen, image[..., 1])
+        normalize_melspec(clean_mel, image[..., 2])
 
-        height, width, _ = image.shape
-        image = cv2.resize(image, (int(width * self.img_size / height), self.img_size))
-        image = np.moveaxis(image, 2, 0)
-        image = (image / 255.0).astype(np.float32)
-
-        tail = offset + self.duration
-        query_string = f"recording_id == '{flac_id}' & "
-        query_string += f"t_min < {tail} & t_max > {offset}"
-        all_tp_events = self.tp.query(query_string)
-
-        label = np.zeros(N_CLASSES, dtype=np.float32)
-        songtype_label = np.zeros(N_CLASSES + 2, dtype=np.float32)
-
-        n_frames = image.shape[2]
-        seconds_per_frame = self.duration / n_frames
-        strong_label = np.zeros((n_frames, N_CLASSES), dtype=np.float32)
-        songtype_strong_label = np.zeros((n_frames, N_CLASSES + 2), dtype=np.float32)
+        if melspec.shape == self.melspec_shape:
+            dsize = self.dsize
+        else:
+            height, width = melspec.shape
+            dsize = (int(width * self.img_size / height), self.img_size)
+        image = cv2.resize(image, dsize, dst=get_scratch("resized", (dsize[1], dsize[0], 3), np.uint8))
+        image = to_chw_float(image)
 
-        for species_id in all_tp_events["species_id"].unique():
-            label[int(species_id)] = 1.0
+        return {
+            "recording_id": flac_id,
+            "image": image,
+            "targets": self.get_targets(flac_id, offset, image.shape[2]),
+            "index": index
+        }
 
-        if self.additional_labels is not None:
-            additional_label = self.additional_labels.query(f"filename == '{flac_id}'").reset_index(drop=True)
-            for _, row in additional_label.iterrows():
-                label[int(row.species)] = self.additional_label_value
 
-        for species_id_song_id in all_tp_events["species_id_song_id"].unique():
-            songtype_label[CLASS_MAP[species_id_song_id]] = 1.0
+class WaveformOnlyDataset(AdditionalLabellDataset):
+    # returns the raw waveform only, features are computed on GPU by
+    # models.featurizer.SpectrogramFeaturizer in the forward pass
+    def __init__(self, df: pd.DataFrame, tp: pd.DataFrame, fp: pd.DataFrame, datadir: Path,
+                 waveform_transforms=None, spectrogram_transforms=None, **params):
+        if spectrogram_transforms:
+            raise ValueError("spectrogram_transforms can't be applied to WaveformOnlyDataset")
+        super().__init__(df, tp, fp, datadir, waveform_transforms, spectrogram_transforms, **params)
+        # width of the image made by the featurizer
+        self.n_frames = self.dsize[0]
 
-        for _, row in all_tp_events.iterrows():
-            t_min = row.t_min
-            t_max = row.t_max
-            species_id = row.species_id
-            species_id_song_id = row.species_id_song_id
+    def __getitem__(self, idx: int):
+        sample = self.tp.loc[idx, :]
+        index = sample["index"]
+        flac_id = sample["recording_id"]
 
-            start_index = int((t_min - offset) / seconds_per_frame)
-            end_index = int((t_max - offset) / seconds_per_frame)
+        offset = self.get_offset(sample["t_min"], sample["t_max"])
+        y = self.get_waveform(flac_id, offset)
+        if self.waveform_transforms:
+            y = self.waveform_transforms(y).astype(np.float32)
 
-            strong_label[start_index:end_index, species_id] = 1.0
-            songtype_strong_label[start_index:end_index, CLASS_MAP[species_id_song_id]] = 1.0
+        waveform = np.zeros(self.n_samples, dtype=np.float32)
+        waveform[:min(len(y), self.n_samples)] = y[:self.n_samples]
 
         return {
             "recording_id": flac_id,
-            "image": image,
-            "targets": {
-                "weak": label,
-                "strong": strong_label,
-                "weak_songtype": songtype_label,
-                "strong_songtype": songtype_strong_label
-            },
+            "waveform": waveform,
+            "targets": self.get_targets(flac_id, offset, self.n_frames),
             "index": index
         }
+
+
+def precompute_features(df: pd.DataFrame, tp: pd.DataFrame, datadir: Path, out_dir: Path, **params):
+    params["precomputed_dir"] = out_dir
+    dataset = AdditionalLabellDataset(df, tp, None, datadir, **params)
+    offsets = set()
+    for _, sample in dataset.tp.iterrows():
+        t_min = sample["t_min"]
+        t_max = sample["t_max"]
+        if not dataset.centering:
+            # every value get_offset can draw: a uniform draw on [low, high) rounded to the 0.1 grid
+            low = max(t_max - dataset.duration, 0.0)
+            high = max(t_min, low + 1e-6)
+            candidates = np.arange(int(np.round(low * 10)), int(np.round(high * 10)) + 1) / 10
+        else:
+            call_duration = t_max - t_min
+            relative_offset = (dataset.duration - call_duration) / 2
+            candidates = [max(0, t_min - relative_offset)]
+        for offset in candidates:
+            offset = min(CLIP_DURATION - dataset.duration, offset)
+            offsets.add((sample["recording_id"], round(offset * 10) / 10))
+
+    for flac_id, offset in sorted(offsets):
+        dataset.load_features(flac_id, offset)
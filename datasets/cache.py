@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from .common import get_params_digest, to_chw_float
+from .sequential import SequentialValidationDataset
+
+
+def get_cache_path(dataset: SequentialValidationDataset, cache_dir: Path):
+    # images only depend on these
+    digest = get_params_digest({
+        "datadir": str(dataset.datadir),
+        "recording_ids": dataset.recording_ids.tolist(),
+        "melspectrogram_parameters": dataset.melspectrogram_parameters,
+        "pcen_parameters": dataset.pcen_parameters,
+        "sampling_rate": dataset.sampling_rate,
+        "img_size": dataset.img_size,
+        "duration": dataset.duration
+    })
+    return Path(cache_dir) / f"sequential_{digest}.npy"
+
+
+def precompute_sequential(dataset: SequentialValidationDataset, out_path: Path):
+    # store every resized uint8 image in a single .npy so that it can be memory mapped
+    out_path = Path(out_path)
+    out_path.parent.mkdir(exist_ok=True, parents=True)
+    first = dataset.compute_image(dataset.get_waveform(*dataset.get_clip(0)))
+
+    # write to a temporary file first since other processes may read the same path
+    tmp_path = out_path.with_name(f"{out_path.name}.{os.getpid()}.tmp")
+    images = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.uint8, shape=(len(dataset),) + first.shape)
+    images[0] = first
+    for idx_ in range(1, len(dataset)):
+        images[idx_] = dataset.compute_image(dataset.get_waveform(*dataset.get_clip(idx_)))
+    images.flush()
+    del images
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+class CachedSequentialDataset(SequentialValidationDataset):
+    # SequentialValidationDataset whose images are computed once and memory mapped
+    # afterwards, only labels are made in __getitem__. transforms have no stable key
+    # to put in the cache path, so they are refused instead of cached
+    def __init__(self, df: pd.DataFrame, tp: pd.DataFrame, fp: pd.DataFrame, datadir: Path,
+                 waveform_transforms=None, spectrogram_transforms=None,
+                 cache_dir="input/cache",
+                 **params):
+        if waveform_transforms or spectrogram_transforms:
+            raise ValueError("CachedSequentialDataset can't cache images made with transforms")
+        if params.get("waveform_only", False):
+            raise ValueError("CachedSequentialDataset caches images, it can't be used with waveform_only")
+        super().__init__(df, tp, fp, datadir, waveform_transforms, spectrogram_transforms, **params)
+        self.cache_path = get_cache_path(self, cache_dir)
+        if not self.cache_path.exists():
+            precompute_sequential(self, self.cache_path)
+        self.images = np.load(self.cache_path, mmap_mode="r")
+
+    def __getitem__(self, idx_: int):
+        flac_id, offset = self.get_clip(idx_)
+        image = to_chw_float(np.asarray(self.images[idx_]))
+        return {
+            "recording_id": flac_id,
+            "image": image.astype(self.dtype, copy=False),
+            "targets": self.get_targets(flac_id, offset, image.shape[2])
+        }
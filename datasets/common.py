@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+import threading
+
+import librosa
+import numpy as np
+import pandas as pd
+import soundfile as sf
+import soxr
+import torch
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
+from pathlib import Path
+
+from .constants import CLASS_MAP
+
+
+STFT_PARAMETER_KEYS = ["n_fft", "hop_length", "win_length", "window", "center", "pad_mode"]
+
+
+def get_params_digest(params: dict):
+    # short stable hash of whatever the cached features depend on, so that changing
+    # any of it writes new files instead of reading stale ones
+    key = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.md5(key.encode()).hexdigest()[:16]
+
+
+def split_melspectrogram_parameters(melspectrogram_parameters: dict, sampling_rate: int):
+    # split melspectrogram parameters into stft part and mel filterbank part
+    # so that the filterbank and the window can be built only once
+    stft_parameters = {"n_fft": 2048, "hop_length": 512}
+    mel_parameters = {}
+    power = 2.0
+    for key, value in melspectrogram_parameters.items():
+        if key in STFT_PARAMETER_KEYS:
+            stft_parameters[key] = value
+        elif key == "power":
+            power = value
+        else:
+            mel_parameters[key] = value
+    win_length = stft_parameters.get("win_length") or stft_parameters["n_fft"]
+    # float32 like the waveform, a float64 window makes stft promote every frame
+    stft_parameters["window"] = librosa.filters.get_window(
+        stft_parameters.get("window", "hann"), win_length, fftbins=True).astype(np.float32)
+    mel_basis = librosa.filters.mel(
+        sr=sampling_rate, n_fft=stft_parameters["n_fft"], dtype=np.float32, **mel_parameters)
+    return stft_parameters, mel_basis, power
+
+
+def melspectrogram(y: np.ndarray, stft_parameters: dict, mel_basis: np.ndarray, power=2.0):
+    return np.dot(mel_basis, np.abs(librosa.stft(y, **stft_parameters)) ** power)
+
+
+def get_image_width(n_samples: int, stft_parameters: dict, n_mels: int, img_size: int):
+    # width of the image resized from the melspectrogram of n_samples samples
+    if stft_parameters.get("center", True):
+        n_stft_frames = 1 + n_samples // stft_parameters["hop_length"]
+    else:
+        n_stft_frames = 1 + (n_samples - stft_parameters["n_fft"]) // stft_parameters["hop_length"]
+    return int(n_stft_frames * img_size / n_mels)
+
+
+def power_to_db_with_clean_mel(melspec: np.ndarray, amin=1e-10, top_db=80.0, out=None):
+    # power_to_db(S ** 1.5) is 1.5 * power_to_db(S) before amin / top_db clipping,
+    # so the log is only taken once and both clippings are applied afterwards.
+    # computed in the dtype of melspec, which can be passed as out to reuse it
+    log_spec = np.maximum(melspec, amin, out=out)
+    np.log10(log_spec, out=log_spec)
+    log_spec *= 10.0
+    clean_mel = 1.5 * log_spec
+    np.maximum(clean_mel, max(clean_mel.max() - top_db, 10.0 * np.log10(amin)), out=clean_mel)
+    np.maximum(log_spec, log_spec.max() - top_db, out=log_spec)
+    return log_spec, clean_mel
+
+
+MAX_OPEN_FILES = 32
+open_files = threading.local()
+
+
+def get_sound_file(path: str):
+    # keep recently used files open so that the header isn't parsed again when the
+    # same recording is read repeatedly. handles are per process since DataLoader
+    # workers must not share the ones inherited from the parent, and per thread
+    # since a SoundFile can't be seeked and read from two threads at once
+    if getattr(open_files, "pid", None) != os.getpid():
+        open_files.files = OrderedDict()
+        open_files.pid = os.getpid()
+    files = open_files.files
+    f = files.get(path)
+    if f is None:
+        f = sf.SoundFile(path)
+        files[path] = f
+        if len(files) > MAX_OPEN_FILES:
+            files.popitem(last=False)[1].close()
+    else:
+        files.move_to_end(path)
+    return f
+
+
+scratch_buffers = {}
+
+
+def get_scratch(name: str, shape: tuple, dtype=np.float32):
+    # per process buffers for intermediates of __getitem__. returned arrays must
+    # not come from here since DataLoader collates a batch only after all of its
+    # samples are fetched
+    buffer = scratch_buffers.get(name)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        scratch_buffers[name] = buffer
+    return buffer
+
+
+def share_array(array: np.ndarray):
+    # read only per event arrays of the datasets. numeric ones are moved to shared
+    # memory so that DataLoader workers map the same pages, object ones (recording
+    # ids) become fixed width strings since reading a python object from a worker
+    # writes its refcount and copies the page
+    if array.dtype == object:
+        return array.astype(str)
+    # copy first since to_numpy() may return a read only view of the frame
+    return torch.from_numpy(np.array(array, order="C")).share_memory_().numpy()
+
+
+rng = None
+rng_pid = None
+
+
+def get_rng():
+    # one PCG64 generator per process, created lazily so that DataLoader workers
+    # don't draw the same stream copied from the parent process
+    global rng, rng_pid
+    if rng is None or rng_pid != os.getpid():
+        rng = np.random.default_rng(torch.initial_seed())
+        rng_pid = os.getpid()
+    return rng
+
+
+def load_audio(path: Path, offset: float, duration: float, sampling_rate: int):
+    # seek instead of decoding from the head of the file, same frame arithmetic as librosa.load
+    f = get_sound_file(str(path))
+    orig_sr = f.samplerate
+    f.seek(int(offset * orig_sr))
+    y = f.read(int(duration * orig_sr), dtype="float32", always_2d=False)
+    if y.ndim > 1:
+        y = y.mean(axis=1)
+    if orig_sr != sampling_rate:
+        y = soxr.resample(y, orig_sr, sampling_rate)
+    return y
+
+
+audio_loader = None
+audio_loader_pid = None
+
+
+def load_audio_async(path: Path, offset: float, duration: float, sampling_rate: int):
+    # load_audio on a background thread of this process, soundfile and soxr release
+    # the GIL so the read overlaps with whatever __getitem__ does meanwhile
+    global audio_loader, audio_loader_pid
+    if audio_loader is None or audio_loader_pid != os.getpid():
+        audio_loader = ThreadPoolExecutor(max_workers=1)
+        audio_loader_pid = os.getpid()
+    return audio_loader.submit(load_audio, path, offset, duration, sampling_rate)
+
+
+def build_event_index(events: pd.DataFrame, songtype=False):
+    # per recording event arrays so that __getitem__ doesn't need to query the whole table
+    event_index = {}
+    for recording_id, group in events.groupby("recording_id"):
+        arrays = [
+            group["t_min"].to_numpy(np.float64),
+            group["t_max"].to_numpy(np.float64),
+            group["species_id"].to_numpy(np.int64)
+        ]
+        if songtype:
+            arrays.append(group["species_id_song_id"].map(CLASS_MAP).to_numpy(np.int64))
+        event_index[recording_id] = tuple(arrays)
+    return event_index
+
+
+def get_events(event_index: dict, recording_id: str, offset: float, duration: float):
+    events = event_index[recording_id]
+    mask = (events[0] < offset + duration) & (events[1] > offset)
+    return tuple(array[mask] for array in events)
+
+
+def get_frame_indices(t_mins: np.ndarray, t_maxs: np.ndarray, offset: float, duration: float, n_frames: int):
+    # events straddling the clip boundary are clipped into [0, n_frames]
+    frames_per_second = n_frames / duration
+    start_indices = np.clip(((t_mins - offset) * frames_per_second).astype(np.int32), 0, n_frames)
+    end_indices = np.clip(((t_maxs - offset) * frames_per_second).astype(np.int32), 0, n_frames)
+    return start_indices, end_indices
+
+
+@njit(cache=True)
+def fill_strong_label(strong_label, start_indices, end_indices, class_ids, value):
+    # strong_label[start:end, class_id] = value for every event
+    for i in range(start_indices.shape[0]):
+        class_id = class_ids[i]
+        for t in range(start_indices[i], end_indices[i]):
+            strong_label[t, class_id] = value
+    return strong_label
+
+
+@njit(cache=True)
+def fill_strong_label_with_songtype(strong_label, songtype_strong_label, start_indices, end_indices,
+                                    species_ids, songtype_ids, value):
+    # species and songtype targets share the event intervals, so both are
+    # written in a single pass over the frames
+    for i in range(start_indices.shape[0]):
+        species_id = species_ids[i]
+        songtype_id = songtype_ids[i]
+        for t in range(start_indices[i], end_indices[i]):
+            strong_label[t, species_id] = value
+            songtype_strong_label[t, songtype_id] = value
+    return strong_label, songtype_strong_label
+
+
+@njit(fastmath=True, cache=True)
+def _normalize_melspec_u8(X, out):
+    # standardizing before min-max scaling doesn't change the result,
+    # so this is a single min/max pass and a single rescale pass
+    eps = 1e-6
+    height, width = X.shape
+    row_min = np.empty(height, dtype=np.float64)
+    row_max = np.empty(height, dtype=np.float64)
+    for h in range(height):
+        mn = X[h, 0]
+        mx = X[h, 0]
+        for w in range(1, width):
+            if X[h, w] < mn:
+                mn = X[h, w]
+            if X[h, w] > mx:
+                mx = X[h, w]
+        row_min[h] = mn
+        row_max[h] = mx
+    norm_min = row_min.min()
+    norm_max = row_max.max()
+
+    if (norm_max - norm_min) > eps:
+        scale = 255.0 / (norm_max - norm_min)
+        for h in range(height):
+            for w in range(width):
+                v = (X[h, w] - norm_min) * scale
+                out[h, w] = np.uint8(min(max(v, 0.0), 255.0))
+    else:
+        # Just zero
+        out[:] = 0
+    return out
+
+
+def normalize_melspec(X: np.ndarray, out=None):
+    if out is None:
+        out = np.empty(X.shape, dtype=np.uint8)
+    return _normalize_melspec_u8(X, out)
+
+
+@njit(cache=True)
+def _hwc_u8_to_chw_f32(src, out):
+    # transpose and rescale to [0, 1] in one pass
+    height, width, n_channels = src.shape
+    for h in range(height):
+        for w in range(width):
+            for c in range(n_channels):
+                out[c, h, w] = src[h, w, c] / 255.0
+    return out
+
+
+def to_chw_float(image: np.ndarray):
+    height, width, n_channels = image.shape
+    return _hwc_u8_to_chw_f32(image, np.empty((n_channels, height, width), dtype=np.float32))
@@ -56,7 +56,7 @@ class RandomSamplingRateAndDurationSpectrogramDataset(torchdata.Dataset):
         self.duration = duration
         self.duration_randomness_ratio = duration_randomness_ratio
         self.sampling_rate_randomness_ratio = sampling_rate_randomness_ratio
-        if len(list(datadir.glob("*.flac"))) == 0:
+        if next(datadir.glob("*.flac"), None) is None:
             self.suffix = ".wav"
         else:
             self.suffix = ".flac"
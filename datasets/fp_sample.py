@@ -6,8 +6,8 @@ import torch.utils.data as torchdata
 
 from pathlib import Path
 
+from .common import normalize_melspec
 from .constants import N_CLASSES, CLIP_DURATION
-from .spectrogram import normalize_melspec
 
 
 class SampleFPSpectrogramDataset(torchdata.Dataset):
@@ -6,26 +6,19 @@ import torch.utils.data as torchdata
 
 from pathlib import Path
 
-from .constants import N_CLASSES, CLIP_DURATION, CLASS_MAP
-
-
-def normalize_melspec(X: np.ndarray):
-    eps = 1e-6
-    mean = X.mean()
-    X = X - mean
-    std = X.std()
-    Xstd = X / (std + eps)
-    norm_min, norm_max = Xstd.min(), Xstd.max()
-    if (norm_max - norm_min) > eps:
-        V = Xstd
-        V[V < norm_min] = norm_min
-        V[V > norm_max] = norm_max
-        V = 255 * (V - norm_min) / (norm_max - norm_min)
-        V = V.astype(np.uint8)
-    else:
-        # Just zero
-        V = np.zeros_like(Xstd, dtype=np.uint8)
-    return V
+from .common import (build_event_index, fill_strong_label, fill_strong_label_with_songtype, get_events,
+                     get_frame_indices, get_image_width, get_rng, get_scratch, load_audio, load_audio_async,
+                     melspectrogram, normalize_melspec, power_to_db_with_clean_mel, share_array,
+                     split_melspectrogram_parameters, to_chw_float)
+from .constants import N_CLASSES, CLIP_DURATION
+from .pcen import pcen_inplace
+
+
+def pick_offset(low: float, high: float, step=0.1):
+    # same as np.random.choice(np.arange(low, high, step)) without building the array,
+    # falls back to low when the range is empty
+    n_steps = max(1, int(np.ceil((high - low) / step)))
+    return low + step * get_rng().integers(n_steps)
 
 
 class WaveformMixupDataset(torchdata.Dataset):
@@ -38,7 +31,9 @@ class WaveformMixupDataset(torchdata.Dataset):
                  duration=10,
                  mixup_prob=0.5,
                  mixup_alpha=5,
-                 float_label=True):
+                 float_label=True,
+                 dtype="float32",
+                 waveform_only=False):
         unique_recording_id = df.recording_id.unique().tolist()
         unique_tp_recordin_id = tp.recording_id.unique().tolist()
         intersection = set(unique_recording_id).intersection(unique_tp_recordin_id)
@@ -51,13 +46,33 @@ class WaveformMixupDataset(torchdata.Dataset):
         self.melspectrogram_parameters = melspectrogram_parameters
         self.pcen_parameters = pcen_parameters
         self.sampling_rate = sampling_rate
+        self.stft_parameters, self.mel_basis, self.power = split_melspectrogram_parameters(
+            melspectrogram_parameters, sampling_rate)
+        self.tp_by_recording = build_event_index(self.tp)
+        # positional arrays so that __getitem__ doesn't build a pd.Series per sample
+        self.recording_ids = share_array(self.tp["recording_id"].to_numpy())
+        self.t_mins = share_array(self.tp["t_min"].to_numpy(np.float64))
+        self.t_maxs = share_array(self.tp["t_max"].to_numpy(np.float64))
+        self.indices = share_array(self.tp["index"].to_numpy())
         self.img_size = img_size
+        # float16 halves the worker -> main process and host -> device copies,
+        # only for models trained with autocast
+        self.dtype = np.dtype(dtype)
         self.duration = duration
         self.mixup_prob = mixup_prob
         self.mixup_alpha = mixup_alpha
         self.float_label = float_label
 
-        if len(list(datadir.glob("*.flac"))) == 0:
+        # return the (mixed) waveform only and leave the features to
+        # models.featurizer.SpectrogramFeaturizer on GPU, which has no spectrogram transforms
+        if waveform_only and spectrogram_transforms:
+            raise ValueError("spectrogram_transforms can't be applied when waveform_only is set")
+        self.waveform_only = waveform_only
+        self.n_samples = int(sampling_rate * duration)
+        self.n_frames = get_image_width(self.n_samples, self.stft_parameters, self.mel_basis.shape[0], img_size)
+
+        # a single match is enough, no need to list the whole directory
+        if next(datadir.glob("*.flac"), None) is None:
             self.suffix = ".wav"
         else:
             self.suffix = ".flac"
@@ -66,145 +81,113 @@ class WaveformMixupDataset(torchdata.Dataset):
         return len(self.tp)
 
     def __getitem__(self, idx: int):
-        sample = self.tp.loc[idx, :]
-        index = sample["index"]
-        flac_id = sample["recording_id"]
+        index = self.indices[idx]
+        flac_id = self.recording_ids[idx]
 
-        t_min = sample["t_min"]
-        t_max = sample["t_max"]
+        t_min = self.t_mins[idx]
+        t_max = self.t_maxs[idx]
 
         call_duration = t_max - t_min
         if call_duration > self.duration:
-            offset = np.random.choice(np.arange(max(t_min - call_duration / 2, 0), t_min + call_duration / 2, 0.1))
+            offset = pick_offset(max(t_min - call_duration / 2, 0), t_min + call_duration / 2)
             offset = min(CLIP_DURATION - self.duration, offset)
         else:
-            offset = np.random.choice(np.arange(max(t_max - self.duration, 0), t_min, 0.1))
+            offset = pick_offset(max(t_max - self.duration, 0), t_min)
             offset = min(CLIP_DURATION - self.duration, offset)
 
-        y, sr = librosa.load(self.datadir / f"{flac_id}{self.suffix}",
-                             sr=self.sampling_rate,
-                             mono=True,
-                             offset=offset,
-                             duration=self.duration)
-        if self.waveform_transforms:
-            y = self.waveform_transforms(y).astype(np.float32)
-
-        melspec = librosa.feature.melspectrogram(y, sr=sr, **self.melspectrogram_parameters)
-
         use_mixup = False
-        if np.random.rand() < self.mixup_prob:
+        if get_rng().random() < self.mixup_prob:
             use_mixup = True
             while True:
-                mixup_sample = self.tp.sample(1).reset_index(drop=True).loc[0]
-                if mixup_sample["index"] != index:
+                j = get_rng().integers(len(self.indices))
+                if self.indices[j] != index:
                     break
-            mixup_flac_id = mixup_sample["recording_id"]
-            mixup_t_min = mixup_sample["t_min"]
-            mixup_t_max = mixup_sample["t_max"]
+            mixup_flac_id = self.recording_ids[j]
+            mixup_t_min = self.t_mins[j]
+            mixup_t_max = self.t_maxs[j]
 
-            mixup_offset = np.random.choice(np.arange(
-                max(mixup_t_max - self.duration, 0), mixup_t_min, 0.1))
+            mixup_offset = pick_offset(max(mixup_t_max - self.duration, 0), mixup_t_min)
             mixup_offset = min(CLIP_DURATION - self.duration, mixup_offset)
 
-            y_mixup, _ = librosa.load(self.datadir / f"{mixup_flac_id}{self.suffix}",
-                                      sr=self.sampling_rate,
-                                      mono=True,
-                                      offset=mixup_offset,
-                                      duration=self.duration)
+            # the partner is read in the background while the main clip is processed
+            mixup_future = load_audio_async(
+                self.datadir / f"{mixup_flac_id}{self.suffix}", mixup_offset, self.duration, self.sampling_rate)
+
+        y = load_audio(self.datadir / f"{flac_id}{self.suffix}", offset, self.duration, self.sampling_rate)
+        if self.waveform_transforms:
+            y = self.waveform_transforms(y).astype(np.float32)
+
+        if use_mixup:
+            y_mixup = mixup_future.result()
             if self.waveform_transforms:
                 y_mixup = self.waveform_transforms(y_mixup).astype(np.float32)
             y_mixup = librosa.util.normalize(y_mixup)
 
-            lam = np.random.beta(self.mixup_alpha, self.mixup_alpha)
-            y_mixed = lam * y + (1 - lam) * y_mixup
-            melspec = librosa.feature.melspectrogram(y_mixed, sr=sr, **self.melspectrogram_parameters)
-
-        pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-        clean_mel = librosa.power_to_db(melspec ** 1.5)
-        melspec = librosa.power_to_db(melspec)
+            # float32 so that mixing doesn't promote the waveforms to float64
+            lam = np.float32(get_rng().beta(self.mixup_alpha, self.mixup_alpha))
+            # mix before the spectrogram so that it is computed once per sample
+            y = lam * y + (1 - lam) * y_mixup
 
-        if self.spectrogram_transforms:
-            melspec = self.spectrogram_transforms(image=melspec)["image"]
-            pcen = self.spectrogram_transforms(image=pcen)["image"]
-            clean_mel = self.spectrogram_transforms(image=clean_mel)["image"]
+        if self.waveform_only:
+            waveform = np.zeros(self.n_samples, dtype=np.float32)
+            waveform[:min(len(y), self.n_samples)] = y[:self.n_samples]
+            n_frames = self.n_frames
         else:
-            pass
+            melspec = melspectrogram(y, self.stft_parameters, self.mel_basis, self.power)
+            pcen = pcen_inplace(melspec, sr=self.sampling_rate, **self.pcen_parameters)
+            melspec, clean_mel = power_to_db_with_clean_mel(melspec, out=melspec)
+
+            if self.spectrogram_transforms:
+                melspec = self.spectrogram_transforms(image=melspec)["image"]
+                pcen = self.spectrogram_transforms(image=pcen)["image"]
+                clean_mel = self.spectrogram_transforms(image=clean_mel)["image"]
+            else:
+                pass
 
-        norm_melspec = normalize_melspec(melspec)
-        norm_pcen = normalize_melspec(pcen)
-        norm_clean_mel = normalize_melspec(clean_mel)
-        image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
+            # each channel is normalized straight into the HWC uint8 image
+            image = get_scratch("spectrogram", melspec.shape + (3,), np.uint8)
+            normalize_melspec(melspec, image[..., 0])
+            normalize_melspec(pcen, image[..., 1])
+            normalize_melspec(clean_mel, image[..., 2])
 
-        height, width, _ = image.shape
-        image = cv2.resize(image, (int(width * self.img_size / height), self.img_size))
-        image = np.moveaxis(image, 2, 0)
-        image = (image / 255.0).astype(np.float32)
+            height, width, _ = image.shape
+            dsize = (int(width * self.img_size / height), self.img_size)
+            image = cv2.resize(image, dsize, dst=get_scratch("resized", (dsize[1], dsize[0], 3), np.uint8))
+            image = to_chw_float(image)
+            n_frames = image.shape[2]
 
-        tail = offset + self.duration
-        query_string = f"recording_id == '{flac_id}' & "
-        query_string += f"t_min < {tail} & t_max > {offset}"
-        all_tp_events = self.tp.query(query_string)
-
-        if use_mixup:
-            mixup_tail = mixup_offset + self.duration
-            query_string = f"recording_id == '{mixup_flac_id}' & "
-            query_string += f"t_min < {mixup_tail} & t_max > {mixup_offset}"
-            mixup_tp_events = self.tp.query(query_string)
+        t_mins, t_maxs, species_ids = get_events(self.tp_by_recording, flac_id, offset, self.duration)
 
         label = np.zeros(N_CLASSES, dtype=np.float32)
-
-        n_frames = image.shape[2]
-        seconds_per_frame = self.duration / n_frames
         strong_label = np.zeros((n_frames, N_CLASSES), dtype=np.float32)
 
-        for species_id in all_tp_events["species_id"].unique():
-            if self.float_label and use_mixup:
-                label[int(species_id)] = lam
-            else:
-                label[int(species_id)] = 1.0
-
-        for _, row in all_tp_events.iterrows():
-            t_min = row.t_min
-            t_max = row.t_max
-            species_id = row.species_id
-
-            start_index = int((t_min - offset) / seconds_per_frame)
-            end_index = int((t_max - offset) / seconds_per_frame)
-
-            if self.float_label and use_mixup:
-                strong_label[start_index:end_index, species_id] = lam
-            else:
-                strong_label[start_index:end_index, species_id] = 1.0
+        value = lam if self.float_label and use_mixup else 1.0
+        label[species_ids] = value
+        start_indices, end_indices = get_frame_indices(t_mins, t_maxs, offset, self.duration, n_frames)
+        fill_strong_label(strong_label, start_indices, end_indices, species_ids, value)
 
         if use_mixup:
-            for species_id in mixup_tp_events["species_id"].unique():
-                if self.float_label:
-                    label[int(species_id)] = (1 - lam)
-                else:
-                    label[int(species_id)] = 1.0
-
-            for _, row in mixup_tp_events.iterrows():
-                t_min = row.t_min
-                t_max = row.t_max
-                species_id = row.species_id
+            t_mins, t_maxs, species_ids = get_events(
+                self.tp_by_recording, mixup_flac_id, mixup_offset, self.duration)
 
-                start_index = int((t_min - mixup_offset) / seconds_per_frame)
-                end_index = int((t_max - mixup_offset) / seconds_per_frame)
+            value = 1 - lam if self.float_label else 1.0
+            label[species_ids] = value
+            start_indices, end_indices = get_frame_indices(t_mins, t_maxs, mixup_offset, self.duration, n_frames)
+            fill_strong_label(strong_label, start_indices, end_indices, species_ids, value)
 
-                if self.float_label:
-                    strong_label[start_index:end_index, species_id] = 1 - lam
-                else:
-                    strong_label[start_index:end_index, species_id] = 1.0
-
-        return {
+        sample = {
             "recording_id": flac_id,
-            "image": image,
             "targets": {
-                "weak": label,
-                "strong": strong_label
+                "weak": label.astype(self.dtype, copy=False),
+                "strong": strong_label.astype(self.dtype, copy=False)
             },
             "index": index
         }
+        if self.waveform_only:
+            sample["waveform"] = waveform.astype(self.dtype, copy=False)
+        else:
+            sample["image"] = image.astype(self.dtype, copy=False)
+        return sample
 
 
 class LogmelMixupDataset(torchdata.Dataset):
@@ -218,7 +201,8 @@ class LogmelMixupDataset(torchdata.Dataset):
                  mixup_prob=0.5,
                  mixup_alpha=5,
                  float_label=False,
-                 no_lambda=False):
+                 no_lambda=False,
+                 dtype="float32"):
         unique_recording_id = df.recording_id.unique().tolist()
         unique_tp_recordin_id = tp.recording_id.unique().tolist()
         intersection = set(unique_recording_id).intersection(unique_tp_recordin_id)
@@ -231,14 +215,24 @@ class LogmelMixupDataset(torchdata.Dataset):
         self.melspectrogram_parameters = melspectrogram_parameters
         self.pcen_parameters = pcen_parameters
         self.sampling_rate = sampling_rate
+        self.stft_parameters, self.mel_basis, self.power = split_melspectrogram_parameters(
+            melspectrogram_parameters, sampling_rate)
+        self.tp_by_recording = build_event_index(self.tp)
+        # positional arrays so that __getitem__ doesn't build a pd.Series per sample
+        self.recording_ids = share_array(self.tp["recording_id"].to_numpy())
+        self.t_mins = share_array(self.tp["t_min"].to_numpy(np.float64))
+        self.t_maxs = share_array(self.tp["t_max"].to_numpy(np.float64))
+        self.indices = share_array(self.tp["index"].to_numpy())
         self.img_size = img_size
+        self.dtype = np.dtype(dtype)
         self.duration = duration
         self.mixup_prob = mixup_prob
         self.mixup_alpha = mixup_alpha
         self.float_label = float_label
         self.no_lambda = no_lambda
 
-        if len(list(datadir.glob("*.flac"))) == 0:
+        # a single match is enough, no need to list the whole directory
+        if next(datadir.glob("*.flac"), None) is None:
             self.suffix = ".wav"
         else:
             self.suffix = ".flac"
@@ -247,65 +241,57 @@ class LogmelMixupDataset(torchdata.Dataset):
         return len(self.tp)
 
     def __getitem__(self, idx: int):
-        sample = self.tp.loc[idx, :]
-        index = sample["index"]
-        flac_id = sample["recording_id"]
+        index = self.indices[idx]
+        flac_id = self.recording_ids[idx]
 
-        t_min = sample["t_min"]
-        t_max = sample["t_max"]
+        t_min = self.t_mins[idx]
+        t_max = self.t_maxs[idx]
 
         call_duration = t_max - t_min
         if call_duration > self.duration:
-            offset = np.random.choice(np.arange(max(t_min - call_duration / 2, 0), t_min + call_duration / 2, 0.1))
+            offset = pick_offset(max(t_min - call_duration / 2, 0), t_min + call_duration / 2)
             offset = min(CLIP_DURATION - self.duration, offset)
         else:
-            offset = np.random.choice(np.arange(max(t_max - self.duration, 0), t_min, 0.1))
+            offset = pick_offset(max(t_max - self.duration, 0), t_min)
             offset = min(CLIP_DURATION - self.duration, offset)
 
-        y, sr = librosa.load(self.datadir / f"{flac_id}{self.suffix}",
-                             sr=self.sampling_rate,
-                             mono=True,
-                             offset=offset,
-                             duration=self.duration)
-        if self.waveform_transforms:
-            y = self.waveform_transforms(y).astype(np.float32)
-
-        melspec = librosa.feature.melspectrogram(y, sr=sr, **self.melspectrogram_parameters)
-
         use_mixup = False
-        if np.random.rand() < self.mixup_prob:
+        if get_rng().random() < self.mixup_prob:
             use_mixup = True
             while True:
-                mixup_sample = self.tp.sample(1).reset_index(drop=True).loc[0]
-                if mixup_sample["index"] != index:
+                j = get_rng().integers(len(self.indices))
+                if self.indices[j] != index:
                     break
-            mixup_flac_id = mixup_sample["recording_id"]
-            mixup_t_min = mixup_sample["t_min"]
-            mixup_t_max = mixup_sample["t_max"]
+            mixup_flac_id = self.recording_ids[j]
+            mixup_t_min = self.t_mins[j]
+            mixup_t_max = self.t_maxs[j]
 
-            mixup_offset = np.random.choice(np.arange(
-                max(mixup_t_max - self.duration, 0), mixup_t_min, 0.1))
+            mixup_offset = pick_offset(max(mixup_t_max - self.duration, 0), mixup_t_min)
             mixup_offset = min(CLIP_DURATION - self.duration, mixup_offset)
 
-            y_mixup, _ = librosa.load(self.datadir / f"{mixup_flac_id}{self.suffix}",
-                                      sr=self.sampling_rate,
-                                      mono=True,
-                                      offset=mixup_offset,
-                                      duration=self.duration)
+            mixup_future = load_audio_async(
+                self.datadir / f"{mixup_flac_id}{self.suffix}", mixup_offset, self.duration, self.sampling_rate)
+
+        y = load_audio(self.datadir / f"{flac_id}{self.suffix}", offset, self.duration, self.sampling_rate)
+        if self.waveform_transforms:
+            y = self.waveform_transforms(y).astype(np.float32)
+
+        melspec = melspectrogram(y, self.stft_parameters, self.mel_basis, self.power)
+
+        if use_mixup:
+            y_mixup = mixup_future.result()
             if self.waveform_transforms:
                 y_mixup = self.waveform_transforms(y_mixup).astype(np.float32)
-            mixup_melspec = librosa.feature.melspectrogram(
-                y_mixup, sr=self.sampling_rate, **self.melspectrogram_parameters)
+            mixup_melspec = melspectrogram(y_mixup, self.stft_parameters, self.mel_basis, self.power)
 
             if self.no_lambda:
                 melspec = melspec + mixup_melspec
             else:
-                lam = np.random.beta(self.mixup_alpha, self.mixup_alpha)
+                lam = np.float32(get_rng().beta(self.mixup_alpha, self.mixup_alpha))
                 melspec = lam * melspec + (1 - lam) * mixup_melspec
 
-        pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-        clean_mel = librosa.power_to_db(melspec ** 1.5)
-        melspec = librosa.power_to_db(melspec)
+        pcen = pcen_inplace(melspec, sr=self.sampling_rate, **self.pcen_parameters)
+        melspec, clean_mel = power_to_db_with_clean_mel(melspec, out=melspec)
 
         if self.spectrogram_transforms:
             melspec = self.spectrogram_transforms(image=melspec)["image"]
@@ -314,80 +300,48 @@ class LogmelMixupDataset(torchdata.Dataset):
         else:
             pass
 
-        norm_melspec = normalize_melspec(melspec)
-        norm_pcen = normalize_melspec(pcen)
-        norm_clean_mel = normalize_melspec(clean_mel)
-        image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
+        # each channel is normalized straight into the HWC uint8 image
+        image = get_scratch("spectrogram", melspec.shape + (3,), np.uint8)
+        normalize_melspec(melspec, image[..., 0])
+        normalize_melspec(pcen, image[..., 1])
+        normalize_melspec(clean_mel, image[..., 2])
 
         height, width, _ = image.shape
         if isinstance(self.img_size, int):
-            image = cv2.resize(image, (int(width * self.img_size / height), self.img_size))
+            dsize = (int(width * self.img_size / height), self.img_size)
+            image = cv2.resize(image, dsize, dst=get_scratch("resized", (dsize[1], dsize[0], 3), np.uint8))
         else:
-            image = cv2.resize(image, tuple(self.img_size))
-        image = np.moveaxis(image, 2, 0)
-        image = (image / 255.0).astype(np.float32)
+            dsize = tuple(self.img_size)
+            image = cv2.resize(image, dsize, dst=get_scratch("resized", (dsize[1], dsize[0], 3), np.uint8))
+        image = to_chw_float(image)
 
-        tail = offset + self.duration
-        query_string = f"recording_id == '{flac_id}' & "
-        query_string += f"t_min < {tail} & t_max > {offset}"
-        all_tp_events = self.tp.query(query_string)
-
-        if use_mixup:
-            mixup_tail = mixup_offset + self.duration
-            query_string = f"recording_id == '{mixup_flac_id}' & "
-            query_string += f"t_min < {mixup_tail} & t_max > {mixup_offset}"
-            mixup_tp_events = self.tp.query(query_string)
+        t_mins, t_maxs, species_ids = get_events(self.tp_by_recording, flac_id, offset, self.duration)
 
         label = np.zeros(N_CLASSES, dtype=np.float32)
+
         n_frames = image.shape[2]
-        seconds_per_frame = self.duration / n_frames
         strong_label = np.zeros((n_frames, N_CLASSES), dtype=np.float32)
 
-        for species_id in all_tp_events["species_id"].unique():
-            if self.float_label and use_mixup and not self.no_lambda:
-                label[int(species_id)] = lam
-            else:
-                label[int(species_id)] = 1.0
-
-        for _, row in all_tp_events.iterrows():
-            t_min = row.t_min
-            t_max = row.t_max
-            species_id = row.species_id
-
-            start_index = int((t_min - offset) / seconds_per_frame)
-            end_index = int((t_max - offset) / seconds_per_frame)
-
-            if self.float_label and use_mixup and not self.no_lambda:
-                strong_label[start_index:end_index, species_id] = lam
-            else:
-                strong_label[start_index:end_index, species_id] = 1.0
+        value = lam if self.float_label and use_mixup and not self.no_lambda else 1.0
+        label[species_ids] = value
+        start_indices, end_indices = get_frame_indices(t_mins, t_maxs, offset, self.duration, n_frames)
+        fill_strong_label(strong_label, start_indices, end_indices, species_ids, value)
 
         if use_mixup:
-            for species_id in mixup_tp_events["species_id"].unique():
-                if self.float_label and not self.no_lambda:
-                    label[int(species_id)] = (1 - lam)
-                else:
-                    label[int(species_id)] = 1.0
+            t_mins, t_maxs, species_ids = get_events(
+                self.tp_by_recording, mixup_flac_id, mixup_offset, self.duration)
 
-            for _, row in mixup_tp_events.iterrows():
-                t_min = row.t_min
-                t_max = row.t_max
-                species_id = row.species_id
-
-                start_index = int((t_min - mixup_offset) / seconds_per_frame)
-                end_index = int((t_max - mixup_offset) / seconds_per_frame)
-
-                if self.float_label and not self.no_lambda:
-                    strong_label[start_index:end_index, species_id] = 1 - lam
-                else:
-                    strong_label[start_index:end_index, species_id] = 1.0
+            value = 1 - lam if self.float_label and not self.no_lambda else 1.0
+            label[species_ids] = value
+            start_indices, end_indices = get_frame_indices(t_mins, t_maxs, mixup_offset, self.duration, n_frames)
+            fill_strong_label(strong_label, start_indices, end_indices, species_ids, value)
 
         return {
             "recording_id": flac_id,
-            "image": image,
+            "image": image.astype(self.dtype, copy=False),
             "targets": {
-                "weak": label,
-                "strong": strong_label
+                "weak": label.astype(self.dtype, copy=False),
+                "strong": strong_label.astype(self.dtype, copy=False)
             },
             "index": index
         }
@@ -402,7 +356,8 @@ class LogmelMixupWithFPDataset(torchdata.Dataset):
                  img_size=224,
                  duration=10,
                  mixup_prob=0.5,
-                 mixup_alpha=5):
+                 mixup_alpha=5,
+                 dtype="float32"):
         unique_recording_id = df.recording_id.unique().tolist()
         unique_tp_recording_id = tp.recording_id.unique().tolist()
         unique_fp_recording_id = fp.recording_id.unique().tolist()
@@ -417,7 +372,18 @@ class LogmelMixupWithFPDataset(torchdata.Dataset):
         self.melspectrogram_parameters = melspectrogram_parameters
         self.pcen_parameters = pcen_parameters
         self.sampling_rate = sampling_rate
+        self.stft_parameters, self.mel_basis, self.power = split_melspectrogram_parameters(
+            melspectrogram_parameters, sampling_rate)
+        self.tp_by_recording = build_event_index(self.tp, songtype=True)
+        # positional arrays so that __getitem__ doesn't build a pd.Series per sample
+        self.recording_ids = share_array(self.tp["recording_id"].to_numpy())
+        self.t_mins = share_array(self.tp["t_min"].to_numpy(np.float64))
+        self.t_maxs = share_array(self.tp["t_max"].to_numpy(np.float64))
+        self.indices = share_array(self.tp["index"].to_numpy())
+        self.fp_recording_ids = share_array(self.fp["recording_id"].to_numpy())
+        self.fp_indices = share_array(self.fp["index"].to_numpy())
         self.img_size = img_size
+        self.dtype = np.dtype(dtype)
         self.duration = duration
         self.mixup_prob = mixup_prob
         self.mixup_alpha = mixup_alpha
@@ -426,57 +392,50 @@ class LogmelMixupWithFPDataset(torchdata.Dataset):
         return len(self.tp)
 
     def __getitem__(self, idx: int):
-        sample = self.tp.loc[idx, :]
-        index = sample["index"]
-        flac_id = sample["recording_id"]
+        index = self.indices[idx]
+        flac_id = self.recording_ids[idx]
 
-        t_min = sample["t_min"]
-        t_max = sample["t_max"]
+        t_min = self.t_mins[idx]
+        t_max = self.t_maxs[idx]
 
         call_duration = t_max - t_min
         if call_duration > self.duration:
-            offset = np.random.choice(np.arange(max(t_min - call_duration / 2, 0), t_min + call_duration / 2, 0.1))
+            offset = pick_offset(max(t_min - call_duration / 2, 0), t_min + call_duration / 2)
             offset = min(CLIP_DURATION - self.duration, offset)
         else:
-            offset = np.random.choice(np.arange(max(t_max - self.duration, 0), t_min, 0.1))
+            offset = pick_offset(max(t_max - self.duration, 0), t_min)
             offset = min(CLIP_DURATION - self.duration, offset)
 
-        y, sr = librosa.load(self.datadir / f"{flac_id}.wav",
-                             sr=self.sampling_rate,
-                             mono=True,
-                             offset=offset,
-                             duration=self.duration)
-        if self.waveform_transforms:
-            y = self.waveform_transforms(y).astype(np.float32)
-
-        melspec = librosa.feature.melspectrogram(y, sr=sr, **self.melspectrogram_parameters)
-
-        if np.random.rand() < self.mixup_prob:
+        use_mixup = False
+        if get_rng().random() < self.mixup_prob:
+            use_mixup = True
             while True:
-                mixup_sample = self.fp.sample(1).reset_index(drop=True).loc[0]
-                if mixup_sample["index"] != index:
+                j = get_rng().integers(len(self.fp_indices))
+                if self.fp_indices[j] != index:
                     break
-            mixup_flac_id = mixup_sample["recording_id"]
+            mixup_flac_id = self.fp_recording_ids[j]
 
-            mixup_offset = np.random.choice(np.arange(
-                0, CLIP_DURATION - self.duration, 0.1))
+            mixup_offset = pick_offset(0, CLIP_DURATION - self.duration)
+            mixup_future = load_audio_async(
+                self.datadir / f"{mixup_flac_id}.wav", mixup_offset, self.duration, self.sampling_rate)
 
-            y_mixup, _ = librosa.load(self.datadir / f"{mixup_flac_id}.wav",
-                                      sr=self.sampling_rate,
-                                      mono=True,
-                                      offset=mixup_offset,
-                                      duration=self.duration)
+        y = load_audio(self.datadir / f"{flac_id}.wav", offset, self.duration, self.sampling_rate)
+        if self.waveform_transforms:
+            y = self.waveform_transforms(y).astype(np.float32)
+
+        melspec = melspectrogram(y, self.stft_parameters, self.mel_basis, self.power)
+
+        if use_mixup:
+            y_mixup = mixup_future.result()
             if self.waveform_transforms:
                 y_mixup = self.waveform_transforms(y_mixup).astype(np.float32)
-            mixup_melspec = librosa.feature.melspectrogram(
-                y_mixup, sr=self.sampling_rate, **self.melspectrogram_parameters)
+            mixup_melspec = melspectrogram(y_mixup, self.stft_parameters, self.mel_basis, self.power)
 
-            lam = np.random.beta(self.mixup_alpha, self.mixup_alpha)
+            lam = np.float32(get_rng().beta(self.mixup_alpha, self.mixup_alpha))
             melspec = lam * melspec + (1 - lam) * mixup_melspec
 
-        pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-        clean_mel = librosa.power_to_db(melspec ** 1.5)
-        melspec = librosa.power_to_db(melspec)
+        pcen = pcen_inplace(melspec, sr=self.sampling_rate, **self.pcen_parameters)
+        melspec, clean_mel = power_to_db_with_clean_mel(melspec, out=melspec)
 
         if self.spectrogram_transforms:
             melspec = self.spectrogram_transforms(image=melspec)["image"]
@@ -485,55 +444,41 @@ class LogmelMixupWithFPDataset(torchdata.Dataset):
         else:
             pass
 
-        norm_melspec = normalize_melspec(melspec)
-        norm_pcen = normalize_melspec(pcen)
-        norm_clean_mel = normalize_melspec(clean_mel)
-        image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
+        # each channel is normalized straight into the HWC uint8 image
+        image = get_scratch("spectrogram", melspec.shape + (3,), np.uint8)
+        normalize_melspec(melspec, image[..., 0])
+        normalize_melspec(pcen, image[..., 1])
+        normalize_melspec(clean_mel, image[..., 2])
 
         height, width, _ = image.shape
-        image = cv2.resize(image, (int(width * self.img_size / height), self.img_size))
-        image = np.moveaxis(image, 2, 0)
-        image = (image / 255.0).astype(np.float32)
+        dsize = (int(width * self.img_size / height), self.img_size)
+        image = cv2.resize(image, dsize, dst=get_scratch("resized", (dsize[1], dsize[0], 3), np.uint8))
+        image = to_chw_float(image)
 
-        tail = offset + self.duration
-        query_string = f"recording_id == '{flac_id}' & "
-        query_string += f"t_min < {tail} & t_max > {offset}"
-        all_tp_events = self.tp.query(query_string)
+        t_mins, t_maxs, species_ids, songtype_ids = get_events(self.tp_by_recording, flac_id, offset, self.duration)
 
         label = np.zeros(N_CLASSES, dtype=np.float32)
         songtype_label = np.zeros(N_CLASSES + 2, dtype=np.float32)
 
         n_frames = image.shape[2]
-        seconds_per_frame = self.duration / n_frames
         strong_label = np.zeros((n_frames, N_CLASSES), dtype=np.float32)
         songtype_strong_label = np.zeros((n_frames, N_CLASSES + 2), dtype=np.float32)
 
-        for species_id in all_tp_events["species_id"].unique():
-            label[int(species_id)] = 1.0
-
-        for species_id_song_id in all_tp_events["species_id_song_id"].unique():
-            songtype_label[CLASS_MAP[species_id_song_id]] = 1.0
-
-        for _, row in all_tp_events.iterrows():
-            t_min = row.t_min
-            t_max = row.t_max
-            species_id = row.species_id
-            species_id_song_id = row.species_id_song_id
-
-            start_index = int((t_min - offset) / seconds_per_frame)
-            end_index = int((t_max - offset) / seconds_per_frame)
+        label[species_ids] = 1.0
+        songtype_label[songtype_ids] = 1.0
 
-            strong_label[start_index:end_index, species_id] = 1.0
-            songtype_strong_label[start_index:end_index, CLASS_MAP[species_id_song_id]] = 1.0
+        start_indices, end_indices = get_frame_indices(t_mins, t_maxs, offset, self.duration, n_frames)
+        fill_strong_label_with_songtype(
+            strong_label, songtype_strong_label, start_indices, end_indices, species_ids, songtype_ids, 1.0)
 
         return {
             "recording_id": flac_id,
-            "image": image,
+            "image": image.astype(self.dtype, copy=False),
             "targets": {
-                "weak": label,
-                "strong": strong_label,
-                "weak_songtype": songtype_label,
-                "strong_songtype": songtype_strong_label
+                "weak": label.astype(self.dtype, copy=False),
+                "strong": strong_label.astype(self.dtype, copy=False),
+                "weak_songtype": songtype_label.astype(self.dtype, copy=False),
+                "strong_songtype": songtype_strong_label.astype(self.dtype, copy=False)
             },
             "index": index
         }
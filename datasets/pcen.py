@@ -0,0 +1,38 @@
+import numpy as np
+import scipy.signal
+
+
+def get_smoothing_coefficient(sr=22050, hop_length=512, time_constant=0.400):
+    # same as the default `b` of librosa.pcen
+    t_frames = time_constant * sr / float(hop_length)
+    return (np.sqrt(1 + 4 * t_frames ** 2) - 1) / (2 * t_frames ** 2)
+
+
+def pcen_inplace(S: np.ndarray, out=None, sr=22050, hop_length=512, gain=0.98, bias=2.0, power=0.5,
+                 time_constant=0.400, eps=1e-6, b=None):
+    # librosa.pcen without its checks and temporaries, for bias > 0 and power > 0.
+    # the smoother starts from the steady state of unit input like librosa and
+    # everything after the filter is done in place in the dtype of S
+    if b is None:
+        b = get_smoothing_coefficient(sr, hop_length, time_constant)
+    if out is None:
+        out = np.empty_like(S)
+
+    filter_b = np.array([b], dtype=S.dtype)
+    filter_a = np.array([1, b - 1], dtype=S.dtype)
+    zi = np.empty((S.shape[0], 1), dtype=S.dtype)
+    zi[:] = scipy.signal.lfilter_zi(filter_b, filter_a)
+    smooth, _ = scipy.signal.lfilter(filter_b, filter_a, S, axis=-1, zi=zi)
+
+    # (eps + M) ** -gain
+    np.add(smooth, eps, out=smooth)
+    np.power(smooth, -gain, out=smooth)
+
+    # (S * smooth + bias) ** power - bias ** power
+    np.multiply(S, smooth, out=out)
+    np.divide(out, bias, out=out)
+    np.log1p(out, out=out)
+    np.multiply(out, power, out=out)
+    np.expm1(out, out=out)
+    np.multiply(out, bias ** power, out=out)
+    return out
@@ -1,31 +1,15 @@
 import cv2
-import librosa
 import numpy as np
 import pandas as pd
 import torch.utils.data as torchdata
 
 from pathlib import Path
 
-from .constants import N_CLASSES, CLIP_DURATION, CLASS_MAP
-
-
-def normalize_melspec(X: np.ndarray):
-    eps = 1e-6
-    mean = X.mean()
-    X = X - mean
-    std = X.std()
-    Xstd = X / (std + eps)
-    norm_min, norm_max = Xstd.min(), Xstd.max()
-    if (norm_max - norm_min) > eps:
-        V = Xstd
-        V[V < norm_min] = norm_min
-        V[V > norm_max] = norm_max
-        V = 255 * (V - norm_min) / (norm_max - norm_min)
-        V = V.astype(np.uint8)
-    else:
-        # Just zero
-        V = np.zeros_like(Xstd, dtype=np.uint8)
-    return V
+from .common import (build_event_index, fill_strong_label_with_songtype, get_events, get_frame_indices, get_image_width,
+                     get_scratch, load_audio, melspectrogram, normalize_melspec, power_to_db_with_clean_mel,
+                     share_array, split_melspectrogram_parameters, to_chw_float)
+from .constants import N_CLASSES, CLIP_DURATION
+from .pcen import pcen_inplace
 
 
 class SequentialValidationDataset(torchdata.Dataset):
@@ -36,7 +20,9 @@ class SequentialValidationDataset(torchdata.Dataset):
                  sampling_rate=32000,
                  img_size=224,
                  duration=10,
-                 centering=False):
+                 centering=False,
+                 dtype="float32",
+                 waveform_only=False):
         unique_recording_id = df.recording_id.unique().tolist()
         unique_tp_recordin_id = tp.recording_id.unique().tolist()
         intersection = set(unique_recording_id).intersection(unique_tp_recordin_id)
@@ -49,34 +35,45 @@ class SequentialValidationDataset(torchdata.Dataset):
         self.melspectrogram_parameters = melspectrogram_parameters
         self.pcen_parameters = pcen_parameters
         self.sampling_rate = sampling_rate
+        self.stft_parameters, self.mel_basis, self.power = split_melspectrogram_parameters(
+            melspectrogram_parameters, sampling_rate)
+        self.tp_by_recording = build_event_index(self.tp, songtype=True)
+        # recording of self.tp.loc[idx] for each idx < len(self.df) that __len__ counts
+        self.recording_ids = share_array(self.tp["recording_id"].to_numpy()[:len(self.df)])
         self.img_size = img_size
+        # "float16" to halve the size of the batches when evaluating with autocast
+        self.dtype = np.dtype(dtype)
         self.duration = duration
         self.centering = centering
 
+        # waveform only for models wrapped with models.featurizer.FeaturizedModel
+        if waveform_only and spectrogram_transforms:
+            raise ValueError("spectrogram_transforms can't be applied when waveform_only is set")
+        self.waveform_only = waveform_only
+        self.n_samples = int(sampling_rate * duration)
+        self.n_frames = get_image_width(self.n_samples, self.stft_parameters, self.mel_basis.shape[0], img_size)
+
     def __len__(self):
         return len(self.df) * (CLIP_DURATION // self.duration)
 
-    def __getitem__(self, idx_: int):
+    def get_clip(self, idx_: int):
         n_chunk_per_clip = CLIP_DURATION // self.duration
         idx = idx_ // n_chunk_per_clip
         segment_id = idx_ % n_chunk_per_clip
+        return self.recording_ids[idx], segment_id * self.duration
 
-        sample = self.tp.loc[idx, :]
-        flac_id = sample["recording_id"]
-
-        offset = segment_id * self.duration
-        y, sr = librosa.load(self.datadir / f"{flac_id}.wav",
-                             sr=self.sampling_rate,
-                             mono=True,
-                             offset=offset,
-                             duration=self.duration)
+    def get_waveform(self, flac_id: str, offset: float):
+        y = load_audio(self.datadir / f"{flac_id}.wav", offset, self.duration, self.sampling_rate)
         if self.waveform_transforms:
             y = self.waveform_transforms(y).astype(np.float32)
+        return y
 
-        melspec = librosa.feature.melspectrogram(y, sr=sr, **self.melspectrogram_parameters)
-        pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-        clean_mel = librosa.power_to_db(melspec ** 1.5)
-        melspec = librosa.power_to_db(melspec)
+    def compute_image(self, y: np.ndarray):
+        # resized (H, W, 3) uint8 image, still to be scaled to [0, 1].
+        # it is a scratch buffer, so copy it before computing the next one
+        melspec = melspectrogram(y, self.stft_parameters, self.mel_basis, self.power)
+        pcen = pcen_inplace(melspec, sr=self.sampling_rate, **self.pcen_parameters)
+        melspec, clean_mel = power_to_db_with_clean_mel(melspec, out=melspec)
 
         if self.spectrogram_transforms:
             melspec = self.spectrogram_transforms(image=melspec)["image"]
@@ -85,54 +82,55 @@ class SequentialValidationDataset(torchdata.Dataset):
         else:
             pass
 
-        norm_melspec = normalize_melspec(melspec)
-        norm_pcen = normalize_melspec(pcen)
-        norm_clean_mel = normalize_melspec(clean_mel)
-        image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
+        # each channel is normalized straight into the HWC uint8 image
+        image = get_scratch("spectrogram", melspec.shape + (3,), np.uint8)
+        normalize_melspec(melspec, image[..., 0])
+        normalize_melspec(pcen, image[..., 1])
+        normalize_melspec(clean_mel, image[..., 2])
 
         height, width, _ = image.shape
-        image = cv2.resize(image, (int(width * self.img_size / height), self.img_size))
-        image = np.moveaxis(image, 2, 0)
-        image = (image / 255.0).astype(np.float32)
+        dsize = (int(width * self.img_size / height), self.img_size)
+        return cv2.resize(image, dsize, dst=get_scratch("resized", (dsize[1], dsize[0], 3), np.uint8))
 
-        tail = offset + self.duration
-        query_string = f"recording_id == '{flac_id}' & "
-        query_string += f"t_min < {tail} & t_max > {offset}"
-        all_tp_events = self.tp.query(query_string)
+    def get_targets(self, flac_id: str, offset: float, n_frames: int):
+        t_mins, t_maxs, species_ids, songtype_ids = get_events(self.tp_by_recording, flac_id, offset, self.duration)
 
         label = np.zeros(N_CLASSES, dtype=np.float32)
         songtype_label = np.zeros(N_CLASSES + 2, dtype=np.float32)
 
-        n_frames = image.shape[2]
-        seconds_per_frame = self.duration / n_frames
         strong_label = np.zeros((n_frames, N_CLASSES), dtype=np.float32)
         songtype_strong_label = np.zeros((n_frames, N_CLASSES + 2), dtype=np.float32)
 
-        for species_id in all_tp_events["species_id"].unique():
-            label[int(species_id)] = 1.0
-
-        for species_id_song_id in all_tp_events["species_id_song_id"].unique():
-            songtype_label[CLASS_MAP[species_id_song_id]] = 1.0
+        label[species_ids] = 1.0
+        songtype_label[songtype_ids] = 1.0
 
-        for _, row in all_tp_events.iterrows():
-            t_min = row.t_min
-            t_max = row.t_max
-            species_id = row.species_id
-            species_id_song_id = row.species_id_song_id
+        start_indices, end_indices = get_frame_indices(t_mins, t_maxs, offset, self.duration, n_frames)
+        fill_strong_label_with_songtype(
+            strong_label, songtype_strong_label, start_indices, end_indices, species_ids, songtype_ids, 1.0)
 
-            start_index = int((t_min - offset) / seconds_per_frame)
-            end_index = int((t_max - offset) / seconds_per_frame)
+        return {
+            "weak": label.astype(self.dtype, copy=False),
+            "strong": strong_label.astype(self.dtype, copy=False),
+            "weak_songtype": songtype_label.astype(self.dtype, copy=False),
+            "strong_songtype": songtype_strong_label.astype(self.dtype, copy=False)
+        }
 
-            strong_label[start_index:end_index, species_id] = 1.0
-            songtype_strong_label[start_index:end_index, CLASS_MAP[species_id_song_id]] = 1.0
+    def __getitem__(self, idx_: int):
+        flac_id, offset = self.get_clip(idx_)
+        y = self.get_waveform(flac_id, offset)
+
+        if self.waveform_only:
+            waveform = np.zeros(self.n_samples, dtype=np.float32)
+            waveform[:min(len(y), self.n_samples)] = y[:self.n_samples]
+            return {
+                "recording_id": flac_id,
+                "waveform": waveform.astype(self.dtype, copy=False),
+                "targets": self.get_targets(flac_id, offset, self.n_frames)
+            }
 
+        image = to_chw_float(self.compute_image(y))
         return {
             "recording_id": flac_id,
-            "image": image,
-            "targets": {
-                "weak": label,
-                "strong": strong_label,
-                "weak_songtype": songtype_label,
-                "strong_songtype": songtype_strong_label
-            }
+            "image": image.astype(self.dtype, copy=False),
+            "targets": self.get_targets(flac_id, offset, image.shape[2])
         }
@@ -8,28 +8,10 @@ import torchaudio
 
 from pathlib import Path
 
+from .common import normalize_melspec
 from .constants import N_CLASSES, CLIP_DURATION, CLASS_MAP, DEFAULT_SR
 
 
-def normalize_melspec(X: np.ndarray):
-    eps = 1e-6
-    mean = X.mean()
-    X = X - mean
-    std = X.std()
-    Xstd = X / (std + eps)
-    norm_min, norm_max = Xstd.min(), Xstd.max()
-    if (norm_max - norm_min) > eps:
-        V = Xstd
-        V[V < norm_min] = norm_min
-        V[V > norm_max] = norm_max
-        V = 255 * (V - norm_min) / (norm_max - norm_min)
-        V = V.astype(np.uint8)
-    else:
-        # Just zero
-        V = np.zeros_like(Xstd, dtype=np.uint8)
-    return V
-
-
 class SpectrogramDataset(torchdata.Dataset):
     def __init__(self, df: pd.DataFrame, tp: pd.DataFrame, fp: pd.DataFrame, datadir: Path,
                  waveform_transforms=None, spectrogram_transforms=None,
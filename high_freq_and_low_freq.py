@@ -17,6 +17,100 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 
+# the per batch lwlrap of the progress bar needs a device to host copy, so it is
+# only computed every LWLRAP_EVERY steps. epoch scores use every batch
+LWLRAP_EVERY = 50
+# every add_scalar serializes an event on the training thread, per batch loss is
+# only written every LOG_EVERY steps
+LOG_EVERY = 10
+# events are kept in memory and written once a minute (and on close) rather than
+# every few scalars, which stalls the training loop on slow / network disks
+WRITER_PARAMS = {"max_queue": 10000, "flush_secs": 60}
+
+
+# inference_mode also skips view / version counter tracking, it only exists from torch 1.9
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
+def to_float32(output: dict):
+    # outputs of autocast regions are float16, losses and metrics are computed in float32
+    return {key: value.float() for key, value in output.items()}
+
+
+def group_by_id(df: pd.DataFrame, columns: list):
+    # rows of columns sorted by recording_id and the start of each recording in them,
+    # recording_ids are sorted like pandas groupby
+    codes, uniques = pd.factorize(df["recording_id"].values, sort=True)
+    order = np.argsort(codes, kind="stable")
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(codes[order])) + 1])
+    return df[columns].values[order], starts, uniques
+
+
+def groupby_max_by_id(df: pd.DataFrame, columns: list):
+    # df.groupby("recording_id")[columns].max().reset_index(drop=False)
+    values, starts, uniques = group_by_id(df, columns)
+    out = np.maximum.reduceat(values, starts, axis=0)
+    out_df = pd.DataFrame(out, columns=columns).astype(df[columns].dtypes.to_dict())
+    out_df.insert(0, "recording_id", uniques)
+    return out_df
+
+
+def groupby_mean_by_id(df: pd.DataFrame, columns: list):
+    # df.groupby("recording_id")[columns].mean().reset_index(drop=False)
+    values, starts, uniques = group_by_id(df, columns)
+    counts = np.diff(np.append(starts, len(values)))
+    out = np.add.reduceat(values.astype(np.float64), starts, axis=0) / counts[:, None]
+    out_df = pd.DataFrame(out, columns=columns)
+    out_df.insert(0, "recording_id", uniques)
+    return out_df
+
+
+def compile_model(model: torch.nn.Module):
+    # nn.Module.compile (torch >= 2.2) compiles in place, so state_dict keys and checkpoints
+    # stay the same as without it
+    model.compile(mode="reduce-overhead")
+    return model
+
+
+def merge_bands(high_df: pd.DataFrame, low_df: pd.DataFrame, ids: pd.DataFrame):
+    # species of one range are taken from the model of that range, species of both are averaged.
+    # filled into a single buffer, the DataFrame is built once around it
+    columns = [f"s{i}" for i in range(24)]
+    high_only = [i for i in range(24) if datasets.SPECIES_RANGE_MAP[i] == ["high"]]
+    low_only = [i for i in range(24) if datasets.SPECIES_RANGE_MAP[i] == ["low"]]
+    both = [i for i in range(24) if i not in high_only + low_only]
+
+    high = high_df[columns].values
+    low = low_df[columns].values
+    merged = np.empty(high.shape, dtype=np.result_type(high, low))
+    merged[:, high_only] = high[:, high_only]
+    merged[:, low_only] = low[:, low_only]
+    merged[:, both] = 0.5 * high[:, both] + 0.5 * low[:, both]
+
+    merged_df = pd.DataFrame(merged, columns=columns)
+    for position, column in enumerate(ids.columns):
+        merged_df.insert(position, column, ids[column].values)
+    return merged_df
+
+
+class EpochOutputs:
+    # (n_samples, ...) buffer on the device of the first batch, filled batch by batch
+    # instead of concatenating a list of batches at the end of the epoch
+    def __init__(self, n_samples: int):
+        self.n_samples = n_samples
+        self.buffer = None
+        self.offset = 0
+
+    def append(self, rows: torch.Tensor):
+        if self.buffer is None:
+            self.buffer = rows.new_empty((self.n_samples,) + rows.shape[1:])
+        self.buffer[self.offset:self.offset + len(rows)] = rows
+        self.offset += len(rows)
+
+    def numpy(self):
+        return self.buffer[:self.offset].cpu().numpy()
+
+
 def train_one_epoch(model,
                     loader,
                     optimizer,
@@ -26,40 +120,45 @@ def train_one_epoch(model,
                     input_key: str,
                     input_target_key: str,
                     epoch: int,
-                    writer: SummaryWriter):
+                    writer: SummaryWriter,
+                    scaler: torch.cuda.amp.GradScaler):
     loss_meter = utils.AverageMeter()
     lwlrap_meter = utils.AverageMeter()
 
     model.train()
 
-    preds = []
-    targs = []
+    preds = EpochOutputs(len(loader.dataset))
+    targs = EpochOutputs(len(loader.dataset))
 
-    progress_bar = tqdm(loader, desc="train")
+    # inputs and targets of the next batch are copied to the device while this one is used
+    progress_bar = tqdm(training.CUDAPrefetcher(loader, device, [input_key, input_target_key]), desc="train")
     for step, batch in enumerate(progress_bar):
-        x = batch[input_key].to(device)
+        x = batch[input_key]
         y = batch[input_target_key]
-        for key in y:
-            y[key] = y[key].to(device)
 
-        output = model(x)
+        with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+            output = model(x)
+        output = to_float32(output)
         loss = criterion(output, y)
 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         loss_meter.update(loss.item(), n=len(loader))
 
-        clipwise_output = output["clipwise_output"].detach().cpu().numpy()
-        target = y["weak"].detach().cpu().numpy()
+        clipwise_output = output["clipwise_output"].detach()
+        target = y["weak"].detach()
 
         preds.append(clipwise_output)
         targs.append(target)
 
-        score_class, weight = clb.lwlrap(target, clipwise_output)
-        score = (score_class * weight).sum()
-        lwlrap_meter.update(score, n=1)
+        compute_lwlrap = step % LWLRAP_EVERY == 0 or step == len(loader) - 1
+        if compute_lwlrap:
+            score_class, weight = clb.lwlrap(target.cpu().numpy(), clipwise_output.cpu().numpy())
+            score = (score_class * weight).sum()
+            lwlrap_meter.update(score, n=1)
 
         progress_bar.set_description(
             f"Epoch: {epoch + 1} "
@@ -68,13 +167,16 @@ def train_one_epoch(model,
             f"lwlrap: {lwlrap_meter.val:.4f} lwlrap(avg) {lwlrap_meter.avg:.4f}")
 
         global_step = epoch * len(loader) + step + 1
-        writer.add_scalar(tag="loss/batch", scalar_value=loss_meter.val, global_step=global_step)
-        writer.add_scalar(tag="lwlrap/batch", scalar_value=lwlrap_meter.val, global_step=global_step)
+        if step % LOG_EVERY == 0:
+            writer.add_scalar(tag="loss/batch", scalar_value=loss_meter.val, global_step=global_step)
+        if compute_lwlrap:
+            writer.add_scalar(tag="lwlrap/batch", scalar_value=lwlrap_meter.val, global_step=global_step)
 
     scheduler.step()
 
-    y_pred = np.concatenate(preds, axis=0)
-    y_true = np.concatenate(targs, axis=0)
+    # copied to host once at the end of the epoch
+    y_pred = preds.numpy()
+    y_true = targs.numpy()
 
     score_class, weight = clb.lwlrap(y_true, y_pred)
     score = (score_class * weight).sum()
@@ -93,48 +195,50 @@ def eval_one_epoch(model,
                    epoch: int,
                    writer: SummaryWriter,
                    aggregate_by_recording=True,
-                   strong=False):
+                   strong=False,
+                   amp=False):
     loss_meter = utils.AverageMeter()
     lwlrap_meter = utils.AverageMeter()
 
     model.eval()
 
-    preds = []
-    targs = []
+    preds = EpochOutputs(len(loader.dataset))
+    targs = EpochOutputs(len(loader.dataset))
     recording_ids = []
     indices = []
-    progress_bar = tqdm(loader, desc="valid")
+    progress_bar = tqdm(training.CUDAPrefetcher(loader, device, [input_key, input_target_key]), desc="valid")
     for step, batch in enumerate(progress_bar):
-        with torch.no_grad():
+        with inference_mode():
             recording_ids.extend(batch["recording_id"])
             if batch.get("index") is not None:
                 with_index = True
                 indices.extend(batch["index"].numpy())
             else:
                 with_index = False
-            x = batch[input_key].to(device)
+            x = batch[input_key]
             y = batch[input_target_key]
 
-            for key in y:
-                y[key] = y[key].to(device)
-
-            output = model(x)
+            with torch.cuda.amp.autocast(enabled=amp):
+                output = model(x)
+            output = to_float32(output)
             loss = criterion(output, y).detach()
 
         loss_meter.update(loss.item(), n=len(loader))
 
         if strong:
-            clipwise_output = output["framewise_output"].detach().cpu().numpy().max(axis=1)
+            clipwise_output = output["framewise_output"].detach().max(dim=1)[0]
         else:
-            clipwise_output = output["clipwise_output"].detach().cpu().numpy()
-        target = y["weak"].detach().cpu().numpy()
+            clipwise_output = output["clipwise_output"].detach()
+        target = y["weak"].detach()
 
         preds.append(clipwise_output)
         targs.append(target)
 
-        score_class, weight = clb.lwlrap(target, clipwise_output)
-        score = (score_class * weight).sum()
-        lwlrap_meter.update(score, n=1)
+        compute_lwlrap = step % LWLRAP_EVERY == 0 or step == len(loader) - 1
+        if compute_lwlrap:
+            score_class, weight = clb.lwlrap(target.cpu().numpy(), clipwise_output.cpu().numpy())
+            score = (score_class * weight).sum()
+            lwlrap_meter.update(score, n=1)
 
         progress_bar.set_description(
             f"Epoch: {epoch + 1} "
@@ -143,11 +247,13 @@ def eval_one_epoch(model,
             f"lwlrap: {lwlrap_meter.val:.4f} lwlrap(avg) {lwlrap_meter.avg:.4f}")
 
         global_step = epoch * len(loader) + step + 1
-        writer.add_scalar(tag="loss/batch", scalar_value=loss_meter.val, global_step=global_step)
-        writer.add_scalar(tag="lwlrap/batch", scalar_value=lwlrap_meter.val, global_step=global_step)
+        if step % LOG_EVERY == 0:
+            writer.add_scalar(tag="loss/batch", scalar_value=loss_meter.val, global_step=global_step)
+        if compute_lwlrap:
+            writer.add_scalar(tag="lwlrap/batch", scalar_value=lwlrap_meter.val, global_step=global_step)
 
-    y_pred = np.concatenate(preds, axis=0)
-    y_true = np.concatenate(targs, axis=0)
+    y_pred = preds.numpy()
+    y_true = targs.numpy()
 
     oof_pred_df = pd.DataFrame(y_pred, columns=[f"s{i}" for i in range(y_pred.shape[1])])
     if with_index:
@@ -170,13 +276,17 @@ def eval_one_epoch(model,
         oof_targ_df
     ], axis=1)
 
+    # always scored per recording, the frames are only aggregated if asked for
+    value_columns = [column for column in oof_pred_df.columns if column != "recording_id"]
+    pred_by_recording = groupby_max_by_id(oof_pred_df, value_columns)
+    targ_by_recording = groupby_max_by_id(oof_targ_df, value_columns)
     if aggregate_by_recording:
-        oof_pred_df = oof_pred_df.groupby("recording_id").max().reset_index(drop=False)
-        oof_targ_df = oof_targ_df.groupby("recording_id").max().reset_index(drop=False)
+        oof_pred_df = pred_by_recording
+        oof_targ_df = targ_by_recording
 
     columns = [f"s{i}" for i in range(24)]
 
-    score_class, weight = clb.lwlrap(oof_targ_df[columns].values, oof_pred_df[columns].values)
+    score_class, weight = clb.lwlrap(targ_by_recording[columns].values, pred_by_recording[columns].values)
     score = (score_class * weight).sum()
 
     writer.add_scalar(tag="loss/epoch", scalar_value=loss_meter.avg, global_step=epoch + 1)
@@ -189,22 +299,22 @@ def get_inference(model,
                   device: torch.device,
                   input_key: str,
                   input_target_key: str,
-                  strong=False):
+                  strong=False,
+                  amp=False):
     recording_ids = []
-    batch_predictions = []
-    for batch in tqdm(loader, leave=True, desc="inference"):
+    batch_predictions = EpochOutputs(len(loader.dataset))
+    for batch in tqdm(training.CUDAPrefetcher(loader, device, [input_key]), leave=True, desc="inference"):
         recording_ids.extend(batch["recording_id"])
-        input_ = batch[global_params["input_key"]].to(device)
-        with torch.no_grad():
+        input_ = batch[input_key]
+        with inference_mode(), torch.cuda.amp.autocast(enabled=amp):
             output = model(input_)
+        output = to_float32(output)
         if strong:
-            batch_predictions.append(
-                output["framewise_output"].detach().cpu().numpy().max(axis=1))
+            batch_predictions.append(output["framewise_output"].detach().max(dim=1)[0])
         else:
-            batch_predictions.append(
-                output["clipwise_output"].detach().cpu().numpy())
+            batch_predictions.append(output["clipwise_output"].detach())
 
-    fold_prediction = np.concatenate(batch_predictions, axis=0)
+    fold_prediction = batch_predictions.numpy()
 
     fold_prediction_df = pd.DataFrame(
         fold_prediction, columns=[f"s{i}" for i in range(fold_prediction.shape[1])])
@@ -213,7 +323,7 @@ def get_inference(model,
         fold_prediction_df
     ], axis=1)
 
-    fold_prediction_df = fold_prediction_df.groupby("recording_id").max().reset_index(drop=False)
+    fold_prediction_df = groupby_max_by_id(fold_prediction_df, [f"s{i}" for i in range(fold_prediction.shape[1])])
     return fold_prediction_df
 
 
@@ -221,13 +331,15 @@ def get_soft_inference(model,
                        loader,
                        device: torch.device,
                        input_key: str,
-                       input_target_key: str):
+                       input_target_key: str,
+                       amp=False):
     soft_prediction = {}
     for batch in tqdm(loader, leave=True, desc="soft inference"):
         recording_id = batch["recording_id"][0]
-        input_ = batch[input_key].squeeze(0).to(device)
-        with torch.no_grad():
+        input_ = batch[input_key].squeeze(0).to(device, non_blocking=True)
+        with inference_mode(), torch.cuda.amp.autocast(enabled=amp):
             output = model(input_)
+        output = to_float32(output)
         framewise_output = output["framewise_output"].detach().cpu().numpy()
         clip_prediction = np.vstack(framewise_output)
         soft_prediction[recording_id] = clip_prediction
@@ -264,10 +376,30 @@ if __name__ == "__main__":
     # environment
     utils.set_seed(global_params["seed"])
     device = training.get_device(global_params["device"])
+    # mixed precision is opt-in and only used on GPU
+    use_amp = global_params.get("amp", False) and device.type == "cuda"
+    # input shapes are fixed within a run, so letting cuDNN pick the fastest
+    # algorithms pays off. it gives up the determinism set by set_seed
+    if global_params.get("cudnn_benchmark", False):
+        torch.backends.cudnn.deterministic = False
+        torch.backends.cudnn.benchmark = True
+    # NHWC weights make convolutions use the tensor core friendly kernels, inputs
+    # are converted by the first convolution
+    memory_format = torch.channels_last if global_params.get("channels_last", False) else torch.contiguous_format
+    # fuses the small pooling / activation ops after the backbone and removes the python overhead
+    # between kernels, opt-in since it needs torch 2.x and compiles again for every new model
+    use_compile = global_params.get("compile", False)
+    if use_compile and not hasattr(torch.nn.Module, "compile"):
+        logger.warning(f"globals.compile needs nn.Module.compile (torch >= 2.2), torch {torch.__version__} runs the model as is")
+        use_compile = False
 
     # data
     tp, fp, train_all, test_all, train_audio, test_audio = datasets.get_metadata(config)
     submission = pd.read_csv(config["data"]["sample_submission_path"])
+    # loaders of both frequency ranges in every fold share the same transforms
+    make_train_loader = datasets.get_train_loader_factory(tp, fp, train_audio, config)
+    # test clips are single crops, without gradients 4x the training batch fits in memory
+    config["loader"]["test"].setdefault("inference_batch_size", 4 * config["loader"]["train"]["batch_size"])
 
     # validation
     splitter = training.get_split(config)
@@ -294,319 +426,191 @@ if __name__ == "__main__":
         val_df = train_all.loc[val_idx, :].reset_index(drop=True)
 
         ##################################################
-        # High Frequency Classes #
+        # High / Low Frequency Classes #
         ##################################################
-
-        logger.info("Training for high frequency classes")
-
-        _logdir_high = _logdir / "high"
-        _logdir_high.mkdir(exist_ok=True, parents=True)
-
-        checkpoints_dir = _logdir_high / "checkpoints"
-        checkpoints_dir.mkdir(exist_ok=True, parents=True)
-
-        train_writer = SummaryWriter(log_dir=_logdir_high / "train_log")
-        valid_writer = SummaryWriter(log_dir=_logdir_high / "valid_log")
-
-        config["dataset"]["train"]["params"]["frequency_range"] = "high"
-        config["dataset"]["valid"]["params"]["frequency_range"] = "high"
-        config["dataset"]["test"]["params"]["frequency_range"] = "high"
-
-        loaders = {
-            phase: datasets.get_train_loader(df_, tp, fp, train_audio, config, phase)
-            for df_, phase in zip([trn_df, val_df], ["train", "valid"])
-        }
-        test_loader = datasets.get_test_loader(test_all, test_audio, config)
-
-        soft_inference_config = {
-            "loader": {
-                "test": {
-                    "batch_size": 1,
-                    "shuffle": False,
-                    "num_workers": config["loader"]["test"]["num_workers"]
-                }
-            },
-            "dataset": {
-                "test": {
-                    "name": "LimitedFrequencySampleWiseSpectrogramTestDataset",
-                    "params": config["dataset"]["test"]["params"]
-                }
-            },
-            "transforms": None
-        }
-
-        val_soft_loader = datasets.get_test_loader(val_df, train_audio, soft_inference_config)
-        test_soft_loader = datasets.get_test_loader(test_all, test_audio, soft_inference_config)
-
-        strong = config["inference"]["prediction_type"] == "strong"
-
-        model = models.get_model(config, fold=i).to(device)
-        criterion = criterions.get_criterion(config)
-        optimizer = training.get_optimizer(model, config)
-        scheduler = training.get_scheduler(optimizer, config)
-
-        best_score = 0.0
-        _metrics = {}
-        if not args.skip_train:
-            for epoch in range(global_params["num_epochs"]):
-                logger.info(f"Epoch: [{epoch+1}/{global_params['num_epochs']}]")
-                train_loss, train_score = train_one_epoch(
-                    model,
-                    loaders["train"],
-                    optimizer,
-                    scheduler,
-                    criterion,
-                    device,
-                    epoch=epoch,
-                    input_key=global_params["input_key"],
-                    input_target_key=global_params["input_target_key"],
-                    writer=train_writer)
-
-                valid_loss, valid_score, _, _ = eval_one_epoch(
-                    model,
-                    loaders["valid"],
-                    criterion,
-                    device,
-                    input_key=global_params["input_key"],
-                    input_target_key=global_params["input_target_key"],
-                    epoch=epoch,
-                    writer=valid_writer,
-                    strong=strong)
-
-                best_score, updated = utils.save_best_model(
-                    model, checkpoints_dir, valid_score, prev_metric=best_score)
-
-                if updated:
-                    _metrics["best"] = {"lwlrap": best_score, "loss": valid_loss, "epoch": epoch + 1}
-                _metrics["last"] = {"lwlrap": valid_score, "loss": valid_loss, "epoch": epoch + 1}
-                _metrics[f"epoch_{epoch + 1}"] = {"lwlrap": valid_score, "loss": valid_loss}
-
-                utils.save_json(_metrics, checkpoints_dir / "_metrics.json")
-
+        for band in ["high", "low"]:
+            logger.info(f"Training for {band} frequency classes")
+
+            _logdir_band = _logdir / band
+            _logdir_band.mkdir(exist_ok=True, parents=True)
+
+            checkpoints_dir = _logdir_band / "checkpoints"
+            checkpoints_dir.mkdir(exist_ok=True, parents=True)
+
+            train_writer = SummaryWriter(log_dir=_logdir_band / "train_log", **WRITER_PARAMS)
+            valid_writer = SummaryWriter(log_dir=_logdir_band / "valid_log", **WRITER_PARAMS)
+
+            config["dataset"]["test"]["params"]["frequency_range"] = band
+
+            loaders = {
+                phase: make_train_loader(df_, phase, frequency_range=band)
+                for df_, phase in zip([trn_df, val_df], ["train", "valid"])
+            }
+            test_loader = datasets.get_test_loader(test_all, test_audio, config)
+
+            soft_inference_config = {
+                "loader": {
+                    "test": {
+                        "batch_size": 1,
+                        "shuffle": False,
+                        "num_workers": config["loader"]["test"]["num_workers"]
+                    }
+                },
+                "dataset": {
+                    "test": {
+                        "name": "LimitedFrequencySampleWiseSpectrogramTestDataset",
+                        "params": config["dataset"]["test"]["params"]
+                    }
+                },
+                "transforms": None
+            }
+
+            val_soft_loader = datasets.get_test_loader(val_df, train_audio, soft_inference_config)
+            test_soft_loader = datasets.get_test_loader(test_all, test_audio, soft_inference_config)
+
+            strong = config["inference"]["prediction_type"] == "strong"
+
+            model = models.get_model(config, fold=i).to(device, memory_format=memory_format)
+            if use_compile:
+                model = compile_model(model)
+            num_epochs = global_params["num_epochs"]
+            if band == "low" and global_params.get("share_backbone", False):
+                # start from the best high frequency weights of this fold instead of the pretrained
+                # ones, which needs fewer epochs (low_num_epochs) than training from scratch
+                model = models.prepare_for_inference(model, _logdir / "high" / "checkpoints" / "best.pth").train()
+                num_epochs = global_params.get("low_num_epochs", num_epochs)
+            criterion = criterions.get_criterion(config)
+            optimizer = training.get_optimizer(model, config)
+            scheduler = training.get_scheduler(optimizer, config)
+            scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
+            aggregate_by_recording = config["dataset"]["valid"]["name"] == "LimitedFrequencySequentialValidationDataset"
+            # oof of the epoch saved as best.pth, kept in memory so that it can't outlive the run
+            best_oof = None
+
+            best_score = 0.0
+            _metrics = {}
+            if not args.skip_train:
+                for epoch in range(num_epochs):
+                    logger.info(f"Epoch: [{epoch+1}/{num_epochs}]")
+                    train_loss, train_score = train_one_epoch(
+                        model,
+                        loaders["train"],
+                        optimizer,
+                        scheduler,
+                        criterion,
+                        device,
+                        epoch=epoch,
+                        input_key=global_params["input_key"],
+                        input_target_key=global_params["input_target_key"],
+                        writer=train_writer,
+                        scaler=scaler)
+
+                    valid_loss, valid_score, oof_pred_df, oof_targ_df = eval_one_epoch(
+                        model,
+                        loaders["valid"],
+                        criterion,
+                        device,
+                        input_key=global_params["input_key"],
+                        input_target_key=global_params["input_target_key"],
+                        epoch=epoch,
+                        writer=valid_writer,
+                        aggregate_by_recording=aggregate_by_recording,
+                        strong=strong,
+                        amp=use_amp)
+
+                    best_score, updated = utils.save_best_model(
+                        model, checkpoints_dir, valid_score, prev_metric=best_score)
+
+                    if updated:
+                        best_oof = (oof_pred_df, oof_targ_df)
+                        _metrics["best"] = {"lwlrap": best_score, "loss": valid_loss, "epoch": epoch + 1}
+                    _metrics["last"] = {"lwlrap": valid_score, "loss": valid_loss, "epoch": epoch + 1}
+                    _metrics[f"epoch_{epoch + 1}"] = {"lwlrap": valid_score, "loss": valid_loss}
+
+                    utils.save_json(_metrics, checkpoints_dir / "_metrics.json")
+
+                    logger.info(
+                        f"{epoch + 1}/{num_epochs} * Epoch {epoch + 1} "
+                        f"(train): lwlrap={train_score:.4f} | loss={train_loss:.4f}")
+                    logger.info(
+                        f"{epoch + 1}/{num_epochs} * Epoch {epoch + 1} "
+                        f"(valid): lwlrap={valid_score:.4f} | loss={valid_loss:.4f}")
                 logger.info(
-                    f"{epoch + 1}/{global_params['num_epochs']} * Epoch {epoch + 1} "
-                    f"(train): lwlrap={train_score:.4f} | loss={train_loss:.4f}")
-                logger.info(
-                    f"{epoch + 1}/{global_params['num_epochs']} * Epoch {epoch + 1} "
-                    f"(valid): lwlrap={valid_score:.4f} | loss={valid_loss:.4f}")
-            logger.info(
-                f"Best epoch: {_metrics['best']['epoch']} lwlrap: {_metrics['best']['lwlrap']} loss: {_metrics['best']['loss']}")
-
-        model = models.prepare_for_inference(model, checkpoints_dir / "best.pth").to(device)
-        aggregate_by_recording = config["dataset"]["valid"]["name"] == "LimitedFrequencySequentialValidationDataset"
-        if args.skip_train:
-            epoch = 0
-        _, _, oof_pred_df, oof_targ_df = eval_one_epoch(
-            model,
-            loaders["valid"],
-            criterion,
-            device,
-            input_key=global_params["input_key"],
-            input_target_key=global_params["input_target_key"],
-            epoch=epoch + 1,
-            writer=valid_writer,
-            aggregate_by_recording=aggregate_by_recording,
-            strong=strong)
-
-        oof_predictions["high"].append(oof_pred_df)
-        oof_targets["high"].append(oof_targ_df)
-
-        fold_prediction = get_inference(
-            model, test_loader, device,
-            input_key=global_params["input_key"],
-            input_target_key=global_params["input_target_key"],
-            strong=strong)
-
-        fold_predictions["high"].append(fold_prediction)
-
-        soft_oof = get_soft_inference(
-            model,
-            loader=val_soft_loader,
-            device=device,
-            input_key=global_params["input_key"],
-            input_target_key=global_params["input_target_key"])
-        high_freq_keys = datasets.RANGE_SPECIES_MAP["high"]
-        for key in soft_oof.keys():
-            soft_oofs[key] = {}
-            soft_oof_pred = soft_oof[key]
-            for high_freq_key in high_freq_keys:
-                soft_oofs[key][high_freq_key] = soft_oof_pred[:, high_freq_key]
-
-        soft_pred = get_soft_inference(
-            model,
-            loader=test_soft_loader,
-            device=device,
-            input_key=global_params["input_key"],
-            input_target_key=global_params["input_target_key"])
-        soft_preds[f"fold{i}"] = {}
-        for key in soft_pred.keys():
-            soft_preds[f"fold{i}"][key] = {}
-            soft_test_pred = soft_pred[key]
-            for high_freq_key in high_freq_keys:
-                soft_preds[f"fold{i}"][key][high_freq_key] = soft_test_pred[:, high_freq_key]
-
-        train_writer.close()
-        valid_writer.close()
-
-        ##################################################
-        # Low Frequency Classes #
-        ##################################################
-
-        logger.info("Training for low frequency classes")
-
-        _logdir_low = _logdir / "low"
-        _logdir_low.mkdir(exist_ok=True, parents=True)
-
-        checkpoints_dir = _logdir_low / "checkpoints"
-        checkpoints_dir.mkdir(exist_ok=True, parents=True)
-
-        train_writer = SummaryWriter(log_dir=_logdir_low / "train_log")
-        valid_writer = SummaryWriter(log_dir=_logdir_low / "valid_log")
-
-        config["dataset"]["train"]["params"]["frequency_range"] = "low"
-        config["dataset"]["valid"]["params"]["frequency_range"] = "low"
-        config["dataset"]["test"]["params"]["frequency_range"] = "low"
-
-        loaders = {
-            phase: datasets.get_train_loader(df_, tp, fp, train_audio, config, phase)
-            for df_, phase in zip([trn_df, val_df], ["train", "valid"])
-        }
-        test_loader = datasets.get_test_loader(test_all, test_audio, config)
-
-        soft_inference_config = {
-            "loader": {
-                "test": {
-                    "batch_size": 1,
-                    "shuffle": False,
-                    "num_workers": config["loader"]["test"]["num_workers"]
-                }
-            },
-            "dataset": {
-                "test": {
-                    "name": "LimitedFrequencySampleWiseSpectrogramTestDataset",
-                    "params": config["dataset"]["test"]["params"]
-                }
-            },
-            "transforms": None
-        }
-
-        val_soft_loader = datasets.get_test_loader(val_df, train_audio, soft_inference_config)
-        test_soft_loader = datasets.get_test_loader(test_all, test_audio, soft_inference_config)
-
-        strong = config["inference"]["prediction_type"] == "strong"
-        model = models.get_model(config, fold=i).to(device)
-        criterion = criterions.get_criterion(config)
-        optimizer = training.get_optimizer(model, config)
-        scheduler = training.get_scheduler(optimizer, config)
-
-        best_score = 0.0
-        _metrics = {}
-        if not args.skip_train:
-            for epoch in range(global_params["num_epochs"]):
-                logger.info(f"Epoch: [{epoch+1}/{global_params['num_epochs']}]")
-                train_loss, train_score = train_one_epoch(
-                    model,
-                    loaders["train"],
-                    optimizer,
-                    scheduler,
-                    criterion,
-                    device,
-                    epoch=epoch,
-                    input_key=global_params["input_key"],
-                    input_target_key=global_params["input_target_key"],
-                    writer=train_writer)
-
-                valid_loss, valid_score, _, _ = eval_one_epoch(
+                    f"Best epoch: {_metrics['best']['epoch']} lwlrap: {_metrics['best']['lwlrap']} loss: {_metrics['best']['loss']}")
+
+            model = models.prepare_for_inference(model, checkpoints_dir / "best.pth").to(device)
+            if best_oof is None:
+                # nothing was saved by this run (--skip_train), validate the loaded best.pth
+                if args.skip_train:
+                    epoch = 0
+                _, _, oof_pred_df, oof_targ_df = eval_one_epoch(
                     model,
                     loaders["valid"],
                     criterion,
                     device,
                     input_key=global_params["input_key"],
                     input_target_key=global_params["input_target_key"],
-                    epoch=epoch,
+                    epoch=epoch + 1,
                     writer=valid_writer,
-                    strong=strong)
-
-                best_score, updated = utils.save_best_model(
-                    model, checkpoints_dir, valid_score, prev_metric=best_score)
-
-                if updated:
-                    _metrics["best"] = {"lwlrap": best_score, "loss": valid_loss, "epoch": epoch + 1}
-                _metrics["last"] = {"lwlrap": valid_score, "loss": valid_loss, "epoch": epoch + 1}
-                _metrics[f"epoch_{epoch + 1}"] = {"lwlrap": valid_score, "loss": valid_loss}
-
-                utils.save_json(_metrics, checkpoints_dir / "_metrics.json")
-
-                logger.info(
-                    f"{epoch + 1}/{global_params['num_epochs']} * Epoch {epoch + 1} "
-                    f"(train): lwlrap={train_score:.4f} | loss={train_loss:.4f}")
-                logger.info(
-                    f"{epoch + 1}/{global_params['num_epochs']} * Epoch {epoch + 1} "
-                    f"(valid): lwlrap={valid_score:.4f} | loss={valid_loss:.4f}")
-            logger.info(
-                f"Best epoch: {_metrics['best']['epoch']} lwlrap: {_metrics['best']['lwlrap']} loss: {_metrics['best']['loss']}")
-
-        model = models.prepare_for_inference(model, checkpoints_dir / "best.pth").to(device)
-        aggregate_by_recording = config["dataset"]["valid"]["name"] == "LimitedFrequencySequentialValidationDataset"
-        if args.skip_train:
-            epoch = 1
-        _, _, oof_pred_df, oof_targ_df = eval_one_epoch(
-            model,
-            loaders["valid"],
-            criterion,
-            device,
-            input_key=global_params["input_key"],
-            input_target_key=global_params["input_target_key"],
-            epoch=epoch + 1,
-            writer=valid_writer,
-            aggregate_by_recording=aggregate_by_recording,
-            strong=strong)
-
-        oof_predictions["low"].append(oof_pred_df)
-        oof_targets["low"].append(oof_targ_df)
-
-        fold_prediction = get_inference(
-            model, test_loader, device,
-            input_key=global_params["input_key"],
-            input_target_key=global_params["input_target_key"],
-            strong=strong)
-
-        fold_predictions["low"].append(fold_prediction)
-
-        soft_oof = get_soft_inference(
-            model,
-            loader=val_soft_loader,
-            device=device,
-            input_key=global_params["input_key"],
-            input_target_key=global_params["input_target_key"])
-        low_freq_keys = datasets.RANGE_SPECIES_MAP["low"]
-        for key in soft_oof.keys():
-            soft_oof_pred = soft_oof[key]
-            for low_freq_key in low_freq_keys:
-                if soft_oofs[key].get(low_freq_key) is not None:
-                    soft_oofs[key][low_freq_key] = (soft_oofs[key][low_freq_key] + soft_oof_pred[:, low_freq_key]) / 2
-                else:
-                    soft_oofs[key][low_freq_key] = soft_oof_pred[:, low_freq_key]
-
-        soft_pred = get_soft_inference(
-            model,
-            loader=test_soft_loader,
-            device=device,
-            input_key=global_params["input_key"],
-            input_target_key=global_params["input_target_key"])
-        for key in soft_pred.keys():
-            soft_test_pred = soft_pred[key]
-            for low_freq_key in low_freq_keys:
-                if soft_preds[f"fold{i}"][key].get(low_freq_key) is not None:
-                    soft_preds[f"fold{i}"][key][low_freq_key] = (
-                        soft_preds[f"fold{i}"][key][low_freq_key] +
-                        soft_test_pred[:, low_freq_key]
-                    ) / 2
-                else:
-                    soft_preds[f"fold{i}"][key][low_freq_key] = soft_test_pred[:, low_freq_key]
-
-        train_writer.close()
-        valid_writer.close()
+                    aggregate_by_recording=aggregate_by_recording,
+                    strong=strong,
+                    amp=use_amp)
+            else:
+                oof_pred_df, oof_targ_df = best_oof
+
+            oof_predictions[band].append(oof_pred_df)
+            oof_targets[band].append(oof_targ_df)
+
+            fold_prediction = get_inference(
+                model, test_loader, device,
+                input_key=global_params["input_key"],
+                input_target_key=global_params["input_target_key"],
+                strong=strong,
+                amp=use_amp)
+
+            fold_predictions[band].append(fold_prediction)
+
+            # species in both ranges are averaged over the two models
+            band_keys = datasets.RANGE_SPECIES_MAP[band]
+            soft_oof = get_soft_inference(
+                model,
+                loader=val_soft_loader,
+                device=device,
+                input_key=global_params["input_key"],
+                input_target_key=global_params["input_target_key"],
+                amp=use_amp)
+            for key in soft_oof.keys():
+                soft_oof_pred = soft_oof[key]
+                soft_oofs.setdefault(key, {})
+                for band_key in band_keys:
+                    if soft_oofs[key].get(band_key) is not None:
+                        soft_oofs[key][band_key] = (soft_oofs[key][band_key] + soft_oof_pred[:, band_key]) / 2
+                    else:
+                        soft_oofs[key][band_key] = soft_oof_pred[:, band_key]
+
+            soft_pred = get_soft_inference(
+                model,
+                loader=test_soft_loader,
+                device=device,
+                input_key=global_params["input_key"],
+                input_target_key=global_params["input_target_key"],
+                amp=use_amp)
+            soft_preds.setdefault(f"fold{i}", {})
+            for key in soft_pred.keys():
+                soft_test_pred = soft_pred[key]
+                soft_preds[f"fold{i}"].setdefault(key, {})
+                for band_key in band_keys:
+                    if soft_preds[f"fold{i}"][key].get(band_key) is not None:
+                        soft_preds[f"fold{i}"][key][band_key] = (
+                            soft_preds[f"fold{i}"][key][band_key] +
+                            soft_test_pred[:, band_key]
+                        ) / 2
+                    else:
+                        soft_preds[f"fold{i}"][key][band_key] = soft_test_pred[:, band_key]
+
+            train_writer.close()
+            valid_writer.close()
 
     for key in soft_oofs:
         np.savez_compressed(soft_oof_dir / key, soft_oofs[key])
@@ -623,46 +627,18 @@ if __name__ == "__main__":
     oof_target_low = pd.concat(oof_targets["low"], axis=0).reset_index(drop=True)
 
     if "index" in oof_df_high.columns:
-        with_index = True
         rec_df = oof_df_high[["recording_id", "index"]]
     else:
-        with_index = False
         rec_df = oof_df_high[["recording_id"]]
 
-    oof_df = pd.concat([
-        rec_df,
-        pd.DataFrame(np.zeros((len(oof_df_high), 24)), columns=[f"s{i}" for i in range(24)])
-    ], axis=1)
-
-    oof_targets_df = pd.concat([
-        rec_df,
-        pd.DataFrame(np.zeros((len(oof_df_high), 24)), columns=[f"s{i}" for i in range(24)])
-    ], axis=1)
-
     folds_prediction_high = pd.concat(fold_predictions["high"], axis=0).reset_index(drop=True)
     folds_prediction_low = pd.concat(fold_predictions["low"], axis=0).reset_index(drop=True)
 
-    folds_prediction_df = pd.concat([
-        folds_prediction_high[["recording_id"]],
-        pd.DataFrame(np.zeros((len(folds_prediction_high), 24)), columns=[f"s{i}" for i in range(24)])
-    ], axis=1)
-
-    for i in range(24):
-        species_id = f"s{i}"
-        if datasets.SPECIES_RANGE_MAP[i] == ["high"]:
-            oof_df[species_id] = oof_df_high[species_id]
-            folds_prediction_df[species_id] = folds_prediction_high[species_id]
-            oof_targets_df[species_id] = oof_target_high[species_id]
-        elif datasets.SPECIES_RANGE_MAP[i] == ["low"]:
-            oof_df[species_id] = oof_df_low[species_id]
-            folds_prediction_df[species_id] = folds_prediction_low[species_id]
-            oof_targets_df[species_id] = oof_target_low[species_id]
-        else:
-            oof_df[species_id] = 0.5 * oof_df_high[species_id] + 0.5 * oof_df_low[species_id]
-            folds_prediction_df[species_id] = 0.5 * folds_prediction_high[species_id] + 0.5 * folds_prediction_low[species_id]
-            oof_targets_df[species_id] = 0.5 * oof_target_high[species_id] + 0.5 * oof_target_low[species_id]
+    oof_df = merge_bands(oof_df_high, oof_df_low, rec_df)
+    oof_targets_df = merge_bands(oof_target_high, oof_target_low, rec_df)
+    folds_prediction_df = merge_bands(folds_prediction_high, folds_prediction_low, folds_prediction_high[["recording_id"]])
 
-    folds_prediction_df = folds_prediction_df.groupby("recording_id").mean().reset_index(drop=False)
+    folds_prediction_df = groupby_mean_by_id(folds_prediction_df, [f"s{i}" for i in range(24)])
 
     oof_df_high.to_csv(submission_file_dir / "oof_high.csv", index=False)
     oof_target_high.to_csv(submission_file_dir / "oof_target_high.csv", index=False)
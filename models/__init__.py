@@ -4,6 +4,7 @@ import torch
 from pathlib import Path
 
 from .effcientnet import EfficientNetSED, TimmEfficientNetSED, TimmEfficientNetSEDMax
+from .featurizer import FeaturizedModel, SpectrogramFeaturizer
 from .layers import AttBlock, AttBlockV2
 from .panns import PANNsCNN14Att
 from .resnest import ResNestSED, ResNestSEDMax
@@ -12,6 +13,15 @@ from .utils import init_layer
 
 
 def get_model(config: dict, fold=0):
+    model = build_model(config, fold)
+    # compute features from raw waveform on the same device as the model
+    featurizer_params = config["model"].get("featurizer")
+    if featurizer_params is not None:
+        model = FeaturizedModel(SpectrogramFeaturizer(**featurizer_params), model)
+    return model
+
+
+def build_model(config: dict, fold=0):
     model_config = config["model"]
     model_name = model_config["name"]
     model_params = model_config["params"]
@@ -6,7 +6,7 @@ import torch.nn.functional as F
 from efficientnet_pytorch import EfficientNet
 
 from .layers import AttBlockV2
-from .utils import init_layer, interpolate, pad_framewise_output
+from .utils import channel_smoothing, init_layer, interpolate, pad_framewise_output
 
 
 class TimmEfficientNetSED(nn.Module):
@@ -39,18 +39,16 @@ class TimmEfficientNetSED(nn.Module):
         x = torch.mean(x, dim=2)
 
         # channel smoothing
-        x1 = F.max_pool1d(x, kernel_size=3, stride=1, padding=1)
-        x2 = F.avg_pool1d(x, kernel_size=3, stride=1, padding=1)
-        x = x1 + x2
+        x = channel_smoothing(x)
 
         x = F.dropout(x, p=0.5, training=self.training)
         x = x.transpose(1, 2)
         x = F.relu_(self.fc1(x))
         x = x.transpose(1, 2)
         x = F.dropout(x, p=0.5, training=self.training)
-        (clipwise_output, norm_att, segmentwise_output) = self.att_block(x)
-        logit = torch.sum(norm_att * self.att_block.cla(x), dim=2)
-        segmentwise_logit = self.att_block.cla(x).transpose(1, 2)
+        (clipwise_output, norm_att, segmentwise_output, cla_logit) = self.att_block.forward_with_logit(x)
+        logit = torch.sum(norm_att * cla_logit, dim=2)
+        segmentwise_logit = cla_logit.transpose(1, 2)
         segmentwise_output = segmentwise_output.transpose(1, 2)
 
         interpolate_ratio = frames_num // segmentwise_output.size(1)
@@ -105,9 +103,7 @@ class TimmEfficientNetSEDMax(nn.Module):
         x = torch.mean(x, dim=2)
 
         # channel smoothing
-        x1 = F.max_pool1d(x, kernel_size=3, stride=1, padding=1)
-        x2 = F.avg_pool1d(x, kernel_size=3, stride=1, padding=1)
-        x = x1 + x2
+        x = channel_smoothing(x)
 
         x = F.dropout(x, p=0.5, training=self.training)
         x = x.transpose(1, 2)
@@ -170,18 +166,16 @@ class EfficientNetSED(nn.Module):
         x = torch.mean(x, dim=2)
 
         # channel smoothing
-        x1 = F.max_pool1d(x, kernel_size=3, stride=1, padding=1)
-        x2 = F.avg_pool1d(x, kernel_size=3, stride=1, padding=1)
-        x = x1 + x2
+        x = channel_smoothing(x)
 
         x = F.dropout(x, p=0.5, training=self.training)
         x = x.transpose(1, 2)
         x = F.relu_(self.fc1(x))
         x = x.transpose(1, 2)
         x = F.dropout(x, p=0.5, training=self.training)
-        (clipwise_output, norm_att, segmentwise_output) = self.att_block(x)
-        logit = torch.sum(norm_att * self.att_block.cla(x), dim=2)
-        segmentwise_logit = self.att_block.cla(x).transpose(1, 2)
+        (clipwise_output, norm_att, segmentwise_output, cla_logit) = self.att_block.forward_with_logit(x)
+        logit = torch.sum(norm_att * cla_logit, dim=2)
+        segmentwise_logit = cla_logit.transpose(1, 2)
         segmentwise_output = segmentwise_output.transpose(1, 2)
 
         interpolate_ratio = frames_num // segmentwise_output.size(1)
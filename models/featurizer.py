@@ -0,0 +1,131 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from datasets.common import split_melspectrogram_parameters
+from datasets.pcen import get_smoothing_coefficient
+
+
+def power_to_db(S: torch.Tensor, amin=1e-10, top_db=80.0):
+    # same as librosa.power_to_db(ref=1.0) applied to each sample separately
+    log_spec = 10.0 * torch.log10(torch.clamp(S, min=amin))
+    if top_db is not None:
+        max_db = log_spec.flatten(1).max(dim=1)[0].view(-1, 1, 1)
+        log_spec = torch.max(log_spec, max_db - top_db)
+    return log_spec
+
+
+def normalize_melspec(X: torch.Tensor, eps=1e-6):
+    # min-max scale each (sample, channel) to [0, 1], zero if it is flat
+    flat = X.flatten(2)
+    norm_min = flat.min(dim=2)[0][..., None, None]
+    norm_max = flat.max(dim=2)[0][..., None, None]
+    scale = norm_max - norm_min
+    valid = scale > eps
+    X = (X - norm_min) / torch.where(valid, scale, torch.ones_like(scale))
+    return X * valid.to(X.dtype)
+
+
+class SpectrogramFeaturizer(nn.Module):
+    def __init__(self,
+                 melspectrogram_parameters={},
+                 pcen_parameters={},
+                 sampling_rate=32000,
+                 img_size=224):
+        super().__init__()
+        self.sampling_rate = sampling_rate
+        self.img_size = img_size
+
+        # torch.stft only takes the window as a tensor, other windows than librosa's
+        # default would need their own construction here
+        window = melspectrogram_parameters.get("window", "hann")
+        if window != "hann":
+            raise ValueError(f"SpectrogramFeaturizer only supports the hann window, got {window}")
+
+        # the same split, filterbank (librosa slaney) and window as the CPU datasets
+        stft_parameters, mel_basis, self.power = split_melspectrogram_parameters(
+            melspectrogram_parameters, sampling_rate)
+        self.n_fft = stft_parameters.pop("n_fft")
+        self.hop_length = stft_parameters.pop("hop_length")
+        self.win_length = stft_parameters.pop("win_length", None) or self.n_fft
+        self.register_buffer("mel_basis", torch.from_numpy(mel_basis))
+        self.register_buffer("window", torch.from_numpy(stft_parameters.pop("window")))
+        # defaults of librosa.stft
+        self.stft_parameters = {"center": True, "pad_mode": "reflect"}
+        self.stft_parameters.update(stft_parameters)
+
+        self.gain = pcen_parameters.get("gain", 0.98)
+        self.bias = pcen_parameters.get("bias", 2.0)
+        self.pcen_power = pcen_parameters.get("power", 0.5)
+        self.eps = pcen_parameters.get("eps", 1e-6)
+        if pcen_parameters.get("b") is not None:
+            self.b = pcen_parameters["b"]
+        else:
+            self.b = get_smoothing_coefficient(
+                sampling_rate, pcen_parameters.get("hop_length", 512), pcen_parameters.get("time_constant", 0.4))
+        # smoothing kernels by (n_frames, dtype, device), input lengths are fixed within a run
+        self.pcen_kernels = {}
+
+    def get_pcen_kernel(self, n_frames: int, dtype: torch.dtype, device: torch.device):
+        key = (n_frames, dtype, device)
+        if key not in self.pcen_kernels:
+            t = torch.arange(n_frames, device=device, dtype=dtype)
+            lag = t[None, :] - t[:, None]
+            self.pcen_kernels[key] = self.b * torch.pow(1 - self.b, lag.clamp(min=0)) * (lag >= 0).to(dtype)
+        return self.pcen_kernels[key]
+
+    def pcen(self, melspec: torch.Tensor):
+        # first order IIR smoother M[t] = (1 - b) M[t - 1] + b E[t] starting from
+        # the steady state of unit input like librosa, written as a single matmul
+        kernel = self.get_pcen_kernel(melspec.size(-1), melspec.dtype, melspec.device)
+        smooth = 1.0 + torch.matmul(melspec - 1.0, kernel)
+        smooth = torch.exp(-self.gain * (np.log(self.eps) + torch.log1p(smooth / self.eps)))
+        return (self.bias ** self.pcen_power) * torch.expm1(
+            self.pcen_power * torch.log1p(melspec * smooth / self.bias))
+
+    def compute_features(self, waveform: torch.Tensor):
+        # (batch_size, n_samples) -> melspec, pcen, clean_mel of (batch_size, n_mels, n_frames),
+        # the same as AdditionalLabellDataset.compute_features
+        spec = torch.stft(
+            waveform.float(),
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            win_length=self.win_length,
+            window=self.window,
+            return_complex=True,
+            **self.stft_parameters).abs() ** self.power
+        melspec = torch.matmul(self.mel_basis, spec)
+
+        pcen = self.pcen(melspec)
+        clean_mel = power_to_db(melspec ** 1.5)
+        melspec = power_to_db(melspec)
+        return melspec, pcen, clean_mel
+
+    def forward(self, waveform: torch.Tensor):
+        # (batch_size, n_samples) -> (batch_size, 3, img_size, width)
+        melspec, pcen, clean_mel = self.compute_features(waveform)
+
+        # like the datasets: each channel is scaled to uint8 levels, resized and
+        # rounded like cv2 does on uint8 images, then brought back to [0, 1]
+        image = torch.stack([melspec, pcen, clean_mel], dim=1)
+        image = torch.floor(normalize_melspec(image) * 255.0)
+        height, width = melspec.shape[1:]
+        image = F.interpolate(
+            image, size=(self.img_size, int(width * self.img_size / height)),
+            mode="bilinear", align_corners=False)
+        return torch.round(image) / 255.0
+
+
+class FeaturizedModel(nn.Module):
+    def __init__(self, featurizer: nn.Module, model: nn.Module):
+        super().__init__()
+        self.featurizer = featurizer
+        self.model = model
+
+    def forward(self, x):
+        # power spectrogram bins overflow float16, so features are always computed in
+        # float32 even when the model runs under autocast
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=False):
+            x = self.featurizer(x)
+        return self.model(x)
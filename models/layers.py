@@ -132,11 +132,18 @@ class AttBlockV2(nn.Module):
         init_layer(self.cla)
 
     def forward(self, x):
+        x, norm_att, cla, _ = self.forward_with_logit(x)
+        return x, norm_att, cla
+
+    def forward_with_logit(self, x):
         # x: (n_samples, n_in, n_time)
+        # also returns self.cla(x) before the nonlinearity, so that callers
+        # needing the logits don't have to run the convolution again
         norm_att = torch.softmax(torch.tanh(self.att(x)), dim=-1)
-        cla = self.nonlinear_transform(self.cla(x))
+        cla_logit = self.cla(x)
+        cla = self.nonlinear_transform(cla_logit)
         x = torch.sum(norm_att * cla, dim=2)
-        return x, norm_att, cla
+        return x, norm_att, cla, cla_logit
 
     def nonlinear_transform(self, x):
         if self.activation == 'linear':
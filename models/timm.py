@@ -43,9 +43,9 @@ class TimmSED(nn.Module):
         x = F.relu_(self.fc1(x))
         x = x.transpose(1, 2)
         x = F.dropout(x, p=0.5, training=self.training)
-        (clipwise_output, norm_att, segmentwise_output) = self.att_block(x)
-        logit = torch.sum(norm_att * self.att_block.cla(x), dim=2)
-        segmentwise_logit = self.att_block.cla(x).transpose(1, 2)
+        (clipwise_output, norm_att, segmentwise_output, cla_logit) = self.att_block.forward_with_logit(x)
+        logit = torch.sum(norm_att * cla_logit, dim=2)
+        segmentwise_logit = cla_logit.transpose(1, 2)
         segmentwise_output = segmentwise_output.transpose(1, 2)
 
         interpolate_ratio = frames_num // segmentwise_output.size(1)
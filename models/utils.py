@@ -34,6 +34,13 @@ def init_weights(model):
         model.bias.data.zero_()
 
 
+def channel_smoothing(x: torch.Tensor):
+    # max_pool1d + avg_pool1d over time, the sum is written into the max_pool1d
+    # output since its backward only needs the indices
+    x1 = F.max_pool1d(x, kernel_size=3, stride=1, padding=1)
+    return x1.add_(F.avg_pool1d(x, kernel_size=3, stride=1, padding=1))
+
+
 def do_mixup(x: torch.Tensor, mixup_lambda: torch.Tensor):
     """Mixup x of even indexes (0, 2, 4, ...) with x of odd indexes
     (1, 3, 5, ...).
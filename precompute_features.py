@@ -0,0 +1,20 @@
+import datasets
+import utils
+
+
+if __name__ == "__main__":
+    # fill the on disk feature cache of AdditionalLabelDataset before training,
+    # instead of lazily from the DataLoader workers of the first epochs
+    args = utils.get_parser().parse_args()
+    config = utils.load_config(args.config)
+
+    dataset_config = config["dataset"]["train"]
+    if dataset_config["name"] != "AdditionalLabelDataset":
+        raise ValueError("features are only precomputed for AdditionalLabelDataset")
+    params = dict(dataset_config["params"])
+    out_dir = params.pop("precomputed_dir", None)
+    if out_dir is None:
+        raise ValueError("dataset.train.params.precomputed_dir is not set")
+
+    tp, fp, train_all, _, train_audio, _ = datasets.get_metadata(config)
+    datasets.precompute_features(train_all, tp, train_audio, out_dir, **params)
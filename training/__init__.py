@@ -7,6 +7,7 @@ from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
 from sklearn import model_selection
 
 from .optimizers import AdaBelief, SAM
+from .prefetcher import CUDAPrefetcher
 from .runners import SAMRunner
 
 
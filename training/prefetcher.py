@@ -0,0 +1,67 @@
+import torch
+
+
+def to_device(value, device: torch.device):
+    if isinstance(value, torch.Tensor):
+        return value.to(device, non_blocking=True)
+    elif isinstance(value, dict):
+        return {key: to_device(v, device) for key, v in value.items()}
+    else:
+        return value
+
+
+def record_stream(value, stream):
+    # tensors allocated on the side stream must not be reused before the
+    # main stream is done with them
+    if isinstance(value, torch.Tensor):
+        value.record_stream(stream)
+    elif isinstance(value, dict):
+        for v in value.values():
+            record_stream(v, stream)
+
+
+class CUDAPrefetcher:
+    # wraps a DataLoader and copies batch[key] for each of keys to the device on a
+    # side stream, so the copy of the next batch overlaps with the current step.
+    # other items (recording_id, index, ...) are left on CPU
+    def __init__(self, loader, device: torch.device, keys: list):
+        self.loader = loader
+        self.device = device
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.loader)
+
+    def move(self, batch: dict):
+        batch = dict(batch)
+        for key in self.keys:
+            if key in batch:
+                batch[key] = to_device(batch[key], self.device)
+        return batch
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.loader:
+                yield self.move(batch)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        iterator = iter(self.loader)
+
+        def preload():
+            batch = next(iterator, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self.move(batch)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for key in self.keys:
+                if key in batch:
+                    record_stream(batch[key], current_stream)
+            next_batch = preload()
+            yield batch